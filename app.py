@@ -2,21 +2,27 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import datetime
+import hashlib
+import json
+import mimetypes
 import os
+import queue
 import sys
 import traceback
 import uuid
-import threading
-import queue
-import time
-from typing import Callable
-from user_agents import parse as parse_user_agent
-from dataclasses import dataclass
-from flask import Flask, render_template, redirect, request, make_response
-from flask_compress import Compress
+from dataclasses import asdict, dataclass
+from flask import Flask, render_template, redirect, request, make_response, send_from_directory
+from werkzeug.security import safe_join
+from markupsafe import Markup
 
+import compression
 import db
 import email_client
+import export
+import jobs
+import metrics
+import notify
+from cache import LruCache
 
 BASE_URL = os.environ["BASE_URL"]
 
@@ -30,34 +36,84 @@ DESCRIPTION_MAX_LENGTH = 1000
 AUTHOR_NAME_MAX_LENGTH = 100
 AUTHOR_EMAIL_MAX_LENGTH = 100
 VOTER_NAME_MAX_LENGTH = 100
+BULK_CHOICES_MAX = 200
+# Form field suffixes of the weekdays of recurring options, Monday first
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
 
-Task = Callable[[], None]
-background_tasks_queue: queue.Queue[Task] = queue.Queue()
+FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get("FRAGMENT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+UA_CACHE_MAX_BYTES = int(os.environ.get("UA_CACHE_MAX_BYTES", str(256 * 1024)))
+DASHBOARD_PAGE_SIZE = int(os.environ.get("DASHBOARD_PAGE_SIZE", "20"))
+UA_FAST_PATH = os.environ.get("UA_FAST_PATH", "true").lower() in ["true", "1", "yes"]
 
 ### Init
 
-def background_thread():
-  print("Background thread started")
-  while True:
-    task = background_tasks_queue.get()
-    task()
-    time.sleep(0.1)
-
 def create_app() -> Flask:
-    threading.Thread(target=background_thread, daemon=True).start()
     app = Flask(__name__)
-    Compress(app)
     return app
 
 app = create_app()
+# Registered first so that its after_request hook runs after all others
+metrics.init_app(app)
 
-### Routes
+def import_lazy_dependencies():
+  """Imports the dependencies that are otherwise loaded on first use.
 
-def voter_selection_on_choice(voter_name: str, choice: db.Choice) -> int | None:
-  for vote in choice.votes:
-    if vote.voter_name == voter_name:
-      return vote.value
-  return None
+  Meant for a gunicorn master with preload_app, so that forked workers share them.
+  """
+  import brotli
+  import user_agents
+  email_client.import_smtp_dependencies()
+
+@app.before_request
+def ensure_job_worker_started():
+  # Under gunicorn the worker is started right after forking, see gunicorn.conf.py
+  jobs.start_worker()
+
+@app.after_request
+def compress_response(response):
+  view = app.view_functions.get(request.endpoint)
+  return compression.compress_response(response, getattr(view, "compression_policy", compression.DEFAULT_POLICY))
+
+### Static assets
+
+ASSETS_DIR = os.path.join(app.static_folder or "static", "dist")
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def load_asset_manifest() -> dict[str, str]:
+  try:
+    with open(os.path.join(ASSETS_DIR, "manifest.json")) as f:
+      return json.load(f)
+  except FileNotFoundError:
+    print("No built assets found, serving static files as is. Run build_assets.py to build them.")
+    return {}
+
+asset_manifest = load_asset_manifest()
+
+@app.template_global()
+def asset_url(name: str) -> str:
+  """Returns the URL of a file in static/, fingerprinted if build_assets.py has been run."""
+  if name in asset_manifest:
+    return f"/static/dist/{asset_manifest[name]}"
+  return f"/static/{name}"
+
+@app.get("/static/dist/<path:filename>")
+@compression.policy(enabled=False)  # served precompressed
+def built_asset(filename):
+  for encoding, suffix in [("br", ".br"), ("gzip", ".gz")]:
+    compressed_path = safe_join(ASSETS_DIR, filename + suffix)
+    if request.accept_encodings[encoding] and compressed_path and os.path.isfile(compressed_path):
+      resp = send_from_directory(ASSETS_DIR, filename + suffix,
+                                 mimetype=mimetypes.guess_type(filename)[0])
+      resp.headers["Content-Encoding"] = encoding
+      break
+  else:
+    resp = send_from_directory(ASSETS_DIR, filename)
+
+  resp.headers["Cache-Control"] = ASSET_CACHE_CONTROL
+  resp.vary.add("Accept-Encoding")
+  return resp
+
+### Routes
 
 def error_page(message: str, code: int = 400):
   return render_template("error.html.j2", error=message), code
@@ -78,6 +134,48 @@ def validate_uuid(s: str) -> bool:
   except ValueError:
     return False
 
+def compute_render_version() -> str:
+  """Hashes the templates and built asset names so that ETags change when a deploy changes the markup."""
+  digest = hashlib.sha1(json.dumps(asset_manifest, sort_keys=True).encode())
+  templates_dir = os.path.join(app.root_path, "templates")
+  for name in sorted(os.listdir(templates_dir)):
+    with open(os.path.join(templates_dir, name), "rb") as f:
+      digest.update(f.read())
+  return digest.hexdigest()
+
+RENDER_VERSION = compute_render_version()
+
+def poll_etag(poll_id: str, version: int, variant: list[str]) -> str:
+  """variant lists everything besides the poll itself that the rendered page depends on."""
+  key = "\0".join([RENDER_VERSION, poll_id, str(version), *variant])
+  return hashlib.sha1(key.encode()).hexdigest()
+
+def is_not_modified(etag: str) -> bool:
+  """Only the ETag is checked, as it covers the variant of the page (see poll_etag) and If-Modified-Since does not."""
+  if not request.if_none_match:
+    return False
+  # compress_response appends the content coding to the ETag, e.g. "<etag>:br",
+  # so only the coding the response would get now matches
+  encoding = compression.negotiated_encoding()
+  etags = {etag, f"{etag}:{encoding}"} if encoding is not None else {etag}
+  return request.if_none_match.star_tag or any(
+    tag in etags for tag in request.if_none_match.as_set(include_weak=True)
+  )
+
+def set_validators(resp, etag: str, last_modified: datetime.datetime):
+  resp.set_etag(etag, weak=True)
+  resp.last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+  resp.headers["Cache-Control"] = "private, no-cache"
+  resp.vary.add("Cookie")
+  return resp
+
+def not_modified_response(etag: str, last_modified: datetime.datetime):
+  """Sends the ETag of the response that is revalidated, which has the content coding appended unless it was too small to compress."""
+  encoding = compression.negotiated_encoding()
+  if encoding is not None and not (request.if_none_match and request.if_none_match.contains_weak(etag)):
+    etag = f"{etag}:{encoding}"
+  return set_validators(make_response("", 304), etag, last_modified)
+
 @app.route("/")
 def index():
   created_poll_codes = []
@@ -85,7 +183,12 @@ def index():
     if k.startswith("diddle_manage_code_"):
       created_poll_codes.append(k.replace("diddle_manage_code_", ""))
 
-  created_polls = db.get_polls_by_codes(created_poll_codes) if len(created_poll_codes) > 0 else []
+  # Every poll on the dashboard has a manage cookie, so there are at most as
+  # many pages as the cookies fill, and larger page numbers would overflow OFFSET
+  max_page = max(1, -(-len(created_poll_codes) // DASHBOARD_PAGE_SIZE))
+  page = min(max(request.args.get("page", 1, type=int), 1), max_page)
+  created_polls = db.get_poll_summaries_by_codes(created_poll_codes, page, DASHBOARD_PAGE_SIZE) \
+    if len(created_poll_codes) > 0 else None
 
   return render_template('index.html.j2',
                          created_polls=created_polls,
@@ -125,10 +228,7 @@ def create():
   )
 
   if email_client.email_enabled:
-    def task():
-      email_client.send_poll_created_email(poll_id=poll.id)
-
-    background_tasks_queue.put(task)
+    jobs.enqueue("poll_created_email", poll_id=poll.id)
 
   resp = make_response(
     redirect(f"/manage/{poll.manage_code}")
@@ -138,76 +238,223 @@ def create():
   return resp
 
 
-VoterNameChoiceIdPair = tuple[str, str]
+# Rendered vote grids keyed by poll version, display mode and year. The grid
+# is the same for every viewer, see render_vote_grid.
+vote_grid_cache: LruCache[str] = LruCache(max_weight=FRAGMENT_CACHE_MAX_BYTES)
+
+def render_vote_grid(poll: db.Poll, display_mode: str, now: datetime.datetime) -> str:
+  """Renders the part of the vote table or list that does not depend on the viewer."""
+  key = (poll.id, poll.version, display_mode, now.year)
+  grid = vote_grid_cache.get(key)
+  if grid is not None:
+    return grid
+
+  if display_mode == "table":
+    # Voters are only shown through their votes
+    grid = render_template("poll_vote_table_grid.html.j2",
+                           poll=poll,
+                           choices=poll.choices,
+                           most_voted_choice_ids=poll.most_voted_choice_ids(),
+                           voters=[voter for voter in poll.voters if voter.voted_choice_ids],
+                           now=now)
+  else:
+    grid = render_template("poll_vote_list_choices.html.j2",
+                           poll=poll,
+                           choices=poll.choices,
+                           most_voted_choice_ids=poll.most_voted_choice_ids(),
+                           now=now)
+
+  vote_grid_cache.put(key, grid, weight=len(grid))
+  return grid
+
+def add_voter_delete_buttons(grid: str, poll: db.Poll, managed_voter_names: dict[str, str]) -> str:
+  """Swaps the plain name cells of the viewer's own voters in a table grid for cells with delete buttons."""
+  for voter_name, voter_code in managed_voter_names.items():
+    plain_cell = render_template("poll_vote_table_voter_cell.html.j2", poll=poll, voter_name=voter_name)
+    managed_cell = render_template("poll_vote_table_voter_cell.html.j2", poll=poll, voter_name=voter_name,
+                                   voter_code=voter_code)
+    grid = grid.replace(plain_cell, managed_cell, 1)
+  return grid
+
+# Default display modes keyed by user agent string, weighted by string length
+display_mode_by_user_agent: LruCache[str] = LruCache(max_weight=UA_CACHE_MAX_BYTES)
+metrics.describe("diddle_user_agent_classifications_total", "counter",
+                 "User agents classified on a display mode cache miss, by the fast path or by ua-parser")
+
+def guess_display_mode(user_agent_string: str) -> str | None:
+  """Classifies common user agents without running the ua-parser regexes, None if unsure."""
+  if any(marker in user_agent_string for marker in ("iPhone", "iPad", "Android", "Mobi", "Tablet")):
+    return "list"
+  if any(marker in user_agent_string for marker in ("Windows NT", "Macintosh", "X11")) \
+      and not any(marker in user_agent_string for marker in ("Windows Phone", "ARM", "Touch", "Kindle", "Silk")):
+    return "table"
+  return None
+
+def default_display_mode(user_agent_string: str) -> str:
+  """Picks the display mode for viewers who have not chosen one: list on phones and tablets, table elsewhere."""
+  display_mode = display_mode_by_user_agent.get(user_agent_string)
+  if display_mode is not None:
+    return display_mode
+
+  display_mode = guess_display_mode(user_agent_string) if UA_FAST_PATH else None
+  if display_mode is not None:
+    metrics.inc("diddle_user_agent_classifications_total", method="fast_path")
+  else:
+    metrics.inc("diddle_user_agent_classifications_total", method="parsed")
+    from user_agents import parse as parse_user_agent
+    user_agent = parse_user_agent(user_agent_string)
+    display_mode = "list" if user_agent.is_mobile or user_agent.is_tablet else "table"
+
+  display_mode_by_user_agent.put(user_agent_string, display_mode, weight=len(user_agent_string))
+  return display_mode
+
 @app.get("/poll/<id>")
+@compression.policy(cache=True)
 def poll(id):
   if not validate_uuid(id):
     return error_page("Invalid poll ID", 400)
 
   prefill_voter_name = request.args.get("prefill_voter_name")
 
-  voter_codes: list[str] = []
+  voter_codes: set[str] = set()
   for k, _ in request.cookies.items():
     if k.startswith("diddle_voter_code_"):
-      voter_codes.append(k.replace("diddle_voter_code_", ""))
+      voter_codes.add(k.replace("diddle_voter_code_", ""))
+
+  display_mode_cookie = request.cookies.get("diddle_display_mode")
+  if display_mode_cookie not in ("table", "list"):
+    display_mode_cookie = None
+  # Without the cookie the display mode is derived from the user agent
+  variant = [
+    display_mode_cookie or request.user_agent.string,
+    prefill_voter_name or "",
+    str(datetime.date.today().year),
+    *sorted(voter_codes),
+  ]
+
+  poll_version = db.get_poll_version(id)
+  if poll_version is None:
+    return error_page("Poll not found", 404)
+  if is_not_modified(poll_etag(id, poll_version.version, variant)):
+    return not_modified_response(poll_etag(id, poll_version.version, variant), poll_version.updated_at)
 
   poll = db.get_poll(id)
   if poll is None:
     return error_page("Poll not found", 404)
 
-  display_mode_cookie = request.cookies.get("diddle_display_mode")
   if display_mode_cookie is None:
-    user_agent = parse_user_agent(request.user_agent.string)
-    if user_agent.is_mobile or user_agent.is_tablet:
-      display_mode = "list"
-    else:
-      display_mode = "table"
+    display_mode = default_display_mode(request.user_agent.string)
   else:
     display_mode = display_mode_cookie
 
-  voter_names_set: set[str] = set()
-  selections: dict[VoterNameChoiceIdPair, int] = {}
   managed_voter_names: dict[str, str] = {}
-  for choice in poll.choices:
-    for vote in choice.votes:
-      selections[(vote.voter_name, choice.id)] = vote.value
-      voter_names_set.add(vote.voter_name)
-
-      if vote.manage_code in voter_codes:
-        managed_voter_names[vote.voter_name] = vote.manage_code
-
-  voter_names = list(voter_names_set)
-  voter_names.sort()
-
-  most_voted_choice_ids: set[str] = set()
-  most_voted_value = 1 # start from 1 to avoid marking 0 votes as most voted
-  for choice in poll.choices:
-    n_votes = 0
-    for vote in choice.votes:
-      n_votes += vote.value
-
-    if n_votes > most_voted_value:
-      most_voted_choice_ids = { choice.id }
-      most_voted_value = n_votes
-    elif n_votes == most_voted_value:
-      most_voted_choice_ids.add(choice.id)
+  if len(voter_codes) > 0:
+    for voter in poll.voters:
+      if voter.voted_choice_ids and voter.manage_code in voter_codes:
+        managed_voter_names[voter.name] = voter.manage_code
+
+  now = datetime.datetime.now()
+  vote_grid = render_vote_grid(poll, display_mode, now)
+  if display_mode == "table":
+    vote_grid = add_voter_delete_buttons(vote_grid, poll, managed_voter_names)
 
   resp = make_response(
     render_template("poll.html.j2",
                     poll=poll,
-                    selections=selections,
                     choices=poll.choices,
-                    most_voted_choice_ids=most_voted_choice_ids,
+                    vote_grid=Markup(vote_grid),
                     prefill_voter_name=prefill_voter_name,
-                    voter_names=voter_names,
                     managed_voter_names=managed_voter_names,
-                    now=datetime.datetime.now(),
+                    now=now,
                     display_mode=display_mode))
 
+  set_validators(resp, poll_etag(poll.id, poll.version, variant), poll.updated_at)
   resp.set_cookie("diddle_display_mode", display_mode,
                   samesite="Lax", secure=False)
   return resp
 
+### Live updates
+
+db.poll_change_listeners.append(notify.publish)
+
+def sse_event(change: db.PollChange) -> str:
+  # The id comes back as Last-Event-ID when the browser reconnects
+  return f"id: {change.version}\ndata: {json.dumps(asdict(change))}\n\n"
+
+@app.get("/poll/<id>/events")
+@compression.policy(enabled=False)
+def poll_events(id):
+  """Streams the changes of a poll as server-sent events, see notify.py and poll.html.j2."""
+  if not validate_uuid(id):
+    return error_page("Invalid poll ID", 400)
+
+  known_version = request.headers.get("Last-Event-ID", type=int)
+  if known_version is None:
+    known_version = request.args.get("version", type=int)
+
+  # Browsers stop reconnecting on an error status, but not on an empty stream
+  if db.get_poll_version(id) is None:
+    return error_page("Poll not found", 404)
+  if not notify.streams.acquire(blocking=False):
+    return error_page("Too many live updates open, try again later", 503)
+
+  def events():
+    with notify.subscribe(id) as changes:
+      poll_version = db.get_poll_version(id)
+      if poll_version is None:
+        # Deleted in the meantime, the reconnecting browser gets the 404
+        return
+      yield f"retry: {notify.SSE_RETRY_MS}\n\n"
+      # Changes made since the page was rendered or the stream was interrupted
+      if known_version is not None and poll_version.version != known_version:
+        yield sse_event(db.PollChange(id, poll_version.version, db.POLL_CHANGE_UNKNOWN))
+
+      while True:
+        try:
+          change = changes.get(timeout=notify.SSE_KEEPALIVE_INTERVAL)
+        except queue.Empty:
+          # Also ends the stream of a client that has gone away, as the write fails
+          yield ": keepalive\n\n"
+          continue
+        if change is None:
+          # The worker is stopping, the browser reconnects to another one
+          return
+        yield sse_event(change)
+        if change.kind == db.POLL_CHANGE_DELETED:
+          return
+
+  resp = app.response_class(events(), mimetype="text/event-stream")
+  resp.headers["Cache-Control"] = "no-store"
+  # Keeps proxies such as nginx from buffering the stream
+  resp.headers["X-Accel-Buffering"] = "no"
+  resp.call_on_close(notify.streams.release)
+  return resp
+
+@app.get("/poll/<id>/grid")
+@compression.policy(cache=True)
+def poll_grid(id):
+  """The part of the vote table or list shared by all viewers, fetched by the live updates of poll.html.j2."""
+  if not validate_uuid(id):
+    return error_page("Invalid poll ID", 400)
+  display_mode = request.args.get("display_mode")
+  if display_mode not in ("table", "list"):
+    return error_page("Invalid display mode", 400)
+
+  variant = [display_mode, str(datetime.date.today().year)]
+  poll_version = db.get_poll_version(id)
+  if poll_version is None:
+    return error_page("Poll not found", 404)
+  if is_not_modified(poll_etag(id, poll_version.version, variant)):
+    return not_modified_response(poll_etag(id, poll_version.version, variant), poll_version.updated_at)
+
+  poll = db.get_poll(id)
+  if poll is None:
+    return error_page("Poll not found", 404)
+
+  resp = make_response(render_vote_grid(poll, display_mode, datetime.datetime.now()))
+  set_validators(resp, poll_etag(poll.id, poll.version, variant), poll.updated_at)
+  return resp
+
 
 @app.post("/poll/<id>/vote")
 def vote_poll(id):
@@ -222,27 +469,28 @@ def vote_poll(id):
   if len(voter_name) > VOTER_NAME_MAX_LENGTH:
     return error_page(f"Voter name must be {VOTER_NAME_MAX_LENGTH} characters or fewer")
 
-  poll = db.get_poll(id)
-  if poll is None:
-    return error_page("Poll not found")
-
-  selections: dict[str, int] = {}
-  for choice in poll.choices:
-    selections[choice.id] = 0
-
+  selected_choice_ids: set[str] = set()
   for k in form.keys():
     if k.startswith("choice_"):
-      choice_id = k.replace("choice_", "")
-      selections[choice_id] = 1
+      selected_choice_ids.add(k.replace("choice_", ""))
 
-  manage_code = db.vote_poll(id, voter_name, selections)
-  if manage_code is None:
+  result = db.vote_poll(id, voter_name, selected_choice_ids)
+  if result.error == db.VOTE_POLL_NOT_FOUND:
+    return error_page("Poll not found")
+  if result.error == db.VOTE_INVALID_CHOICE:
+    return error_page("Some of the selected options no longer exist")
+  if result.error == db.VOTE_NAME_IN_USE:
     return error_page("That name is already in use")
 
+  manage_code = result.manage_code
+
   if email_client.email_enabled:
-    def task():
-      email_client.send_participation_email(poll_id=id, voter_name=voter_name)
-    background_tasks_queue.put(task)
+    jobs.enqueue_coalesced("participation_email",
+                           coalesce_key=f"participation_email:{id}",
+                           list_field="voter_names",
+                           value=voter_name,
+                           delay_seconds=email_client.EMAIL_DIGEST_WINDOW,
+                           poll_id=id)
 
   response = make_response(
     redirect(f"/poll/{id}")
@@ -339,28 +587,109 @@ def add_choice(code):
   if form["start_datetime"] > form["end_datetime"]:
     return error_page("Start datetime must be before end datetime")
 
-  start_datetime = form["start_datetime"]
-  if len(start_datetime) == 10:
-    start_datetime += " 00:00:00"
-  else:
-    start_datetime = start_datetime.replace("T", " ")
-    start_datetime += ":00"
-
-  end_datetime = form["end_datetime"]
-  if len(end_datetime) == 10:
-    end_datetime += " 23:59:00"
-  else:
-    end_datetime = end_datetime.replace("T", " ")
-    end_datetime += ":00"
-
   db.add_choice_to_poll(
     code,
-    start_datetime,
-    end_datetime,
+    form_datetime_to_db(form["start_datetime"], is_end=False),
+    form_datetime_to_db(form["end_datetime"], is_end=True),
   )
 
   return redirect(f"/manage/{code}?focus_next=1")
 
+def form_datetime_to_db(value: str, is_end: bool) -> str:
+  """Converts the value of a date or datetime-local input to db.DB_DATE_FORMAT. Whole days end at 23:59."""
+  if len(value) == 10:
+    return value + (" 23:59:00" if is_end else " 00:00:00")
+  return value.replace("T", " ") + ":00"
+
+def expand_recurrence(from_date: datetime.date, to_date: datetime.date, weekdays: set[int],
+                      day_start: datetime.time | None, day_end: datetime.time | None,
+                      step: datetime.timedelta, limit: int) -> list[tuple[str, str]]:
+  """Returns the slots on the weekdays (0 is Monday) from from_date to to_date, both included.
+
+  Without day_start every day is one whole-day slot, otherwise it has slots
+  of length step from day_start up to day_end. Raises ValueError if there
+  would be more than limit slots.
+  """
+  slots: list[tuple[str, str]] = []
+  for days in range((to_date - from_date).days + 1):
+    date = from_date + datetime.timedelta(days=days)
+    if date.weekday() in weekdays:
+      if day_start is None or day_end is None:
+        slots.append((f"{date.isoformat()} 00:00:00", f"{date.isoformat()} 23:59:00"))
+      else:
+        start = datetime.datetime.combine(date, day_start)
+        while start + step <= datetime.datetime.combine(date, day_end) and len(slots) <= limit:
+          slots.append((start.strftime(db.DB_DATE_FORMAT), (start + step).strftime(db.DB_DATE_FORMAT)))
+          start += step
+      if len(slots) > limit:
+        raise ValueError(f"More than {limit} slots")
+  return slots
+
+@app.post("/manage/<code>/add_choices")
+def add_choices(code):
+  """Adds several options at once: every start_datetime and end_datetime pair, or the slots of a recurrence."""
+  if not validate_uuid(code):
+    return error_page("Invalid manage code", 400)
+
+  form = request.form
+  starts = form.getlist("start_datetime")
+  ends = form.getlist("end_datetime")
+  if len(starts) > 0 or len(ends) > 0:
+    if len(starts) != len(ends):
+      return error_page("Every start datetime needs an end datetime")
+    if len(starts) > BULK_CHOICES_MAX:
+      return error_page(f"At most {BULK_CHOICES_MAX} options can be added at once")
+    slots = []
+    for start, end in zip(starts, ends):
+      if len(start) == 0 or len(end) == 0:
+        return error_page("Start and end datetimes are required")
+      slot = (form_datetime_to_db(start, is_end=False), form_datetime_to_db(end, is_end=True))
+      try:
+        datetime.datetime.strptime(slot[0], db.DB_DATE_FORMAT)
+        datetime.datetime.strptime(slot[1], db.DB_DATE_FORMAT)
+      except ValueError:
+        return error_page("Invalid datetime")
+      if slot[0] > slot[1]:
+        return error_page("Start datetime must be before end datetime")
+      slots.append(slot)
+  else:
+    try:
+      from_date = datetime.date.fromisoformat(form.get("from_date", ""))
+      to_date = datetime.date.fromisoformat(form.get("to_date", ""))
+      # Whole-day polls have no times in the form
+      day_start = datetime.time.fromisoformat(form["day_start"]) if "day_start" in form else None
+      day_end = datetime.time.fromisoformat(form["day_end"]) if "day_end" in form else None
+      step_minutes = int(form.get("step_minutes", "60"))
+    except ValueError:
+      return error_page("Invalid date, time or step")
+    weekdays = {i for i, weekday in enumerate(WEEKDAYS) if f"weekday_{weekday}" in form}
+    if len(weekdays) == 0:
+      return error_page("Select at least one weekday")
+    if from_date > to_date:
+      return error_page("The first date must be before the last date")
+    if (to_date - from_date).days > 366:
+      return error_page("The dates can be at most a year apart")
+    if step_minutes < 5 or step_minutes > 24 * 60:
+      return error_page("Slots must be between 5 minutes and a day long")
+    try:
+      slots = expand_recurrence(from_date, to_date, weekdays, day_start, day_end, datetime.timedelta(minutes=step_minutes),
+                                limit=BULK_CHOICES_MAX)
+    except ValueError:
+      return error_page(f"At most {BULK_CHOICES_MAX} options can be added at once")
+    except OverflowError:
+      # Slots past the year 9999
+      return error_page("Invalid date, time or step")
+    if len(slots) == 0:
+      return error_page("No slots fit in the given days and times")
+
+  result = db.add_choices_to_poll(code, slots)
+  if result is None:
+    return error_page("Poll not found", 404)
+
+  # Shown by manage.html.j2
+  skipped = f"&skipped={result.duplicates}" if result.duplicates > 0 else ""
+  return redirect(f"/manage/{code}?focus_next=1{skipped}")
+
 @app.post("/manage/<code>/delete_choice/<choice_id>")
 def delete_choice(code, choice_id):
   if not validate_uuid(code):
@@ -375,10 +704,17 @@ def delete_choice(code, choice_id):
   return redirect(f"/manage/{code}?focus_next=1")
 
 @app.get("/manage/<code>")
+@compression.policy(cache=True)
 def manage(code):
   if not validate_uuid(code):
     return error_page("Invalid manage code", 400)
 
+  poll_version = db.get_poll_version_by_code(code)
+  if poll_version is None:
+    return error_page("Poll not found")
+  if is_not_modified(poll_etag(poll_version.id, poll_version.version, [])):
+    return not_modified_response(poll_etag(poll_version.id, poll_version.version, []), poll_version.updated_at)
+
   poll = db.get_poll_by_code(code)
   if poll is None:
     return error_page("Poll not found")
@@ -388,10 +724,35 @@ def manage(code):
     render_template("manage.html.j2",
                     poll=poll,
                     last_choice_id=last_choice_id))
+  set_validators(resp, poll_etag(poll.id, poll.version, []), poll.updated_at)
   resp.set_cookie(f"diddle_manage_code_{code}", "1",
                   samesite="Strict", secure=False)
   return resp
 
+@app.get("/manage/<code>/export.<format>")
+@compression.policy(enabled=False)
+def export_poll(code, format):
+  """Streams the votes of a poll as CSV or JSON, or its most voted options as iCalendar, see export.py."""
+  if not validate_uuid(code):
+    return error_page("Invalid manage code", 400)
+  if format not in export.FORMATS:
+    return error_page("Unknown export format", 404)
+
+  poll_version = db.get_poll_version_by_code(code)
+  if poll_version is None:
+    return error_page("Poll not found", 404)
+
+  mimetype, generate = export.FORMATS[format]
+  def chunks():
+    with db.export_poll(code) as poll_export:
+      if poll_export is not None:
+        yield from generate(poll_export)
+
+  resp = app.response_class(chunks(), mimetype=mimetype)
+  resp.headers["Content-Disposition"] = f'attachment; filename="diddle-{poll_version.id}.{format}"'
+  resp.headers["Cache-Control"] = "no-store"
+  return resp
+
 @app.post("/manage/<code>/delete")
 def delete_poll(code):
   if not validate_uuid(code):
@@ -425,3 +786,61 @@ def toggle_display_mode():
   resp.set_cookie("diddle_display_mode", display_mode,
                   samesite="Lax", secure=False)
   return resp
+
+### Metrics
+
+metrics.describe("diddle_cache_hits_total", "counter", "In-process cache hits")
+metrics.describe("diddle_cache_misses_total", "counter", "In-process cache misses")
+metrics.describe("diddle_cache_evictions_total", "counter", "In-process cache evictions")
+metrics.describe("diddle_cache_weight", "gauge", "Total weight of the entries of in-process caches")
+metrics.describe("diddle_compression_cpu_seconds_total", "counter", "CPU time spent compressing responses")
+metrics.describe("diddle_compression_bytes_in_total", "counter", "Bytes of responses before compression")
+metrics.describe("diddle_compression_bytes_out_total", "counter", "Bytes of responses after compression")
+metrics.describe("diddle_compression_cache_hits_total", "counter", "Responses served with a cached compressed body")
+metrics.describe("diddle_db_pool_connections_opened_total", "counter", "SQLite connections opened by the pool")
+metrics.describe("diddle_db_pool_connections_reused_total", "counter", "SQLite connections reused from the pool")
+metrics.describe("diddle_email_connections_opened_total", "counter", "Authenticated SMTP sessions opened")
+metrics.describe("diddle_email_messages_sent_total", "counter",
+                 "Emails sent, divided by diddle_email_connections_opened_total gives the messages per SMTP session")
+metrics.describe("diddle_email_idle_connections", "gauge", "SMTP sessions kept open for reuse")
+
+@metrics.register_collector
+def collect_app_metrics():
+  caches = [
+    ("poll", db.poll_cache),
+    ("vote_grid", vote_grid_cache),
+    ("user_agent", display_mode_by_user_agent),
+    ("compressed_body", compression.compressed_bodies),
+  ]
+  for name, cache in caches:
+    stats = cache.stats()
+    yield "diddle_cache_hits_total", {"cache": name}, stats["hits"]
+    yield "diddle_cache_misses_total", {"cache": name}, stats["misses"]
+    yield "diddle_cache_evictions_total", {"cache": name}, stats["evictions"]
+    yield "diddle_cache_weight", {"cache": name}, stats["weight"]
+
+  for encoding, stats in compression.stats().items():
+    yield "diddle_compression_cpu_seconds_total", {"encoding": encoding}, stats["cpu_seconds"]
+    yield "diddle_compression_bytes_in_total", {"encoding": encoding}, stats["bytes_in"]
+    yield "diddle_compression_bytes_out_total", {"encoding": encoding}, stats["bytes_out"]
+    yield "diddle_compression_cache_hits_total", {"encoding": encoding}, stats["cache_hits"]
+
+  pool_stats = db.db.pool_stats()
+  yield "diddle_db_pool_connections_opened_total", {}, pool_stats["opened"]
+  yield "diddle_db_pool_connections_reused_total", {}, pool_stats["reused"]
+
+  if email_client.email_enabled:
+    smtp_stats = email_client.smtp_pool.stats()
+    yield "diddle_email_connections_opened_total", {}, smtp_stats["connections_opened"]
+    yield "diddle_email_messages_sent_total", {}, smtp_stats["messages_sent"]
+    yield "diddle_email_idle_connections", {}, smtp_stats["idle"]
+
+@app.get("/metrics")
+def prometheus_metrics():
+  if not metrics.METRICS_ENABLED:
+    return error_page("Not found", 404)
+
+  resp = make_response(metrics.render_prometheus())
+  resp.mimetype = "text/plain"
+  resp.headers["Cache-Control"] = "no-store"
+  return resp
@@ -2,12 +2,13 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
+import runpy
 import db
 
 migrations_dir = 'migrations'  # Relative directory path
 
 # Get all migration files
-migration_files = sorted(os.listdir(migrations_dir))
+migration_files = sorted(f for f in os.listdir(migrations_dir) if f.endswith(('.sql', '.py')))
 
 db.ensure_migration_table_exists()
 
@@ -24,9 +25,19 @@ for migration_file in migration_files:
   print(migration_sql)
   number = int(migration_file.split('_')[0])
 
-  if db.ensure_migration_applied(number, migration_sql):
+  # .py migrations define migrate(cur) for changes that SQL alone cannot do
+  if migration_file.endswith('.py'):
+    applied = db.ensure_python_migration_applied(number, runpy.run_path(migration_path)['migrate'])
+  else:
+    applied = db.ensure_migration_applied(number, migration_sql)
+
+  if applied:
     print(f"* Migration applied: {migration_path}\n")
     num_applied += 1
+    # Migrations that rebuild tables run with foreign keys off
+    violations = db.foreign_key_violations()
+    if len(violations) > 0:
+      raise Exception(f"{len(violations)} rows with broken foreign keys after {migration_path}, e.g. {violations[:5]}")
   else:
     print(f"* Migration already applied: {migration_path}\n")
 
@@ -0,0 +1,89 @@
+"""Fixtures shared by the benchmarks: temporary databases, poll shapes and run information."""
+import datetime
+import os
+import platform
+import random
+import subprocess
+import sys
+from dataclasses import dataclass
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@dataclass
+class Shape:
+    """`polls` polls with `choices` choices and `voters` voters each, written as POLLSxCHOICESxVOTERS."""
+    polls: int
+    choices: int
+    voters: int
+
+    def __str__(self) -> str:
+        return f"{self.polls}x{self.choices}x{self.voters}"
+
+def parse_shape(value: str) -> Shape:
+    polls, choices, voters = (int(n) for n in value.split("x"))
+    return Shape(polls, choices, voters)
+
+# Many small polls and a few huge ones
+DEFAULT_SHAPES = [Shape(200, 10, 10), Shape(3, 100, 300)]
+
+@dataclass
+class SeededPoll:
+    id: str
+    manage_code: str
+    choice_ids: list[str]
+
+def make_env(tmp_dir: str) -> dict[str, str]:
+    """Environment of the app with a database in `tmp_dir` and without email."""
+    env = dict(os.environ)
+    env["DB_PATH"] = os.path.join(tmp_dir, "db.sqlite3")
+    env["BASE_URL"] = "http://localhost"
+    for var in list(env):
+        if var.startswith("EMAIL_"):
+            del env[var]
+    return env
+
+def create_database(env: dict[str, str]) -> None:
+    subprocess.run([sys.executable, "apply_migrations.py"], cwd=REPO_DIR, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+def seed(shape: Shape, author_email: str | None = None, rng: random.Random | None = None) -> list[SeededPoll]:
+    """Creates the polls of `shape` through db, which must be imported with DB_PATH set.
+
+    Every voter votes yes on about half of the choices, chosen by `rng`, so
+    that seeds are reproducible.
+    """
+    import db
+
+    rng = rng or random.Random(0)
+    polls = []
+    start = datetime.datetime(2030, 1, 1, 9)
+    for i in range(shape.polls):
+        poll = db.create_poll(f"Poll {i} ({shape})", "Seeded by bench/fixtures.py", "Author", author_email, False)
+        for j in range(shape.choices):
+            choice_start = start + datetime.timedelta(days=j // 8, hours=j % 8)
+            db.add_choice_to_poll(poll.manage_code,
+                                  choice_start.strftime(db.DB_DATE_FORMAT),
+                                  (choice_start + datetime.timedelta(minutes=30)).strftime(db.DB_DATE_FORMAT))
+        choice_ids = [choice.id for choice in db.get_poll(poll.id).choices]
+        for j in range(shape.voters):
+            db.vote_poll(poll.id, f"Voter {j}", {choice_id for choice_id in choice_ids if rng.random() < 0.5})
+        polls.append(SeededPoll(poll.id, poll.manage_code, choice_ids))
+    return polls
+
+def run_info() -> dict:
+    """Identifies the measured code and machine, so that results of different commits can be compared."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+    }
@@ -0,0 +1,240 @@
+"""Load test: concurrent client processes against gunicorn, with a local SMTP server standing in for the email host.
+
+Usage: python bench/load.py [--shape 20x20x30] [--clients 8] [--duration 10] [--workers 4]
+                            [--mix poll_table=40,poll_list=30,vote=20,manage=10]
+
+Seeds a temporary database with polls of the given shape, starts gunicorn
+with gunicorn.conf.py and the EMAIL_ variables pointing at the local SMTP
+server, and runs the client processes for the given number of seconds. Each
+client picks requests at random according to the mix. Votes enqueue
+participation emails, which are counted once the job queue has drained.
+Prints throughput and latencies per request kind as JSON.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import socket
+import socketserver
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from dataclasses import asdict
+
+from fixtures import REPO_DIR, SeededPoll, create_database, make_env, parse_shape, run_info, seed
+
+REQUEST_KINDS = ["poll_table", "poll_list", "vote", "manage"]
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """Accepts every command, authentication included, and counts the messages it receives."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SmtpHandler)
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.connections = 0
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server: SmtpSink = self.server  # type: ignore
+        with server.lock:
+            server.connections += 1
+        self.wfile.write(b"220 localhost\r\n")
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line == b".\r\n":
+                    in_data = False
+                    with server.lock:
+                        server.messages += 1
+                    self.wfile.write(b"250 OK\r\n")
+                continue
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.wfile.write(b"250-localhost\r\n250 AUTH PLAIN LOGIN\r\n")
+            elif command == b"AUTH":
+                self.wfile.write(b"235 OK\r\n")
+            elif command == b"DATA":
+                in_data = True
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+def parse_mix(value: str) -> dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in REQUEST_KINDS:
+            raise argparse.ArgumentTypeError(f"Unknown request kind {kind}, expected one of {', '.join(REQUEST_KINDS)}")
+        mix[kind] = int(weight)
+    return mix
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def send(port: int, kind: str, poll: dict, voter_name: str, rng: random.Random) -> int:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        headers = {"Accept-Encoding": "br, gzip"}
+        if kind in ("poll_table", "poll_list"):
+            headers["Cookie"] = f"diddle_display_mode={kind.removeprefix('poll_')}"
+            conn.request("GET", f"/poll/{poll['id']}", headers=headers)
+        elif kind == "manage":
+            conn.request("GET", f"/manage/{poll['manage_code']}", headers=headers)
+        else:
+            form = {"voter_name": voter_name}
+            form.update((f"choice_{choice_id}", "on") for choice_id in poll["choice_ids"] if rng.random() < 0.5)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            conn.request("POST", f"/poll/{poll['id']}/vote", body=urllib.parse.urlencode(form), headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+def run_client(number: int, port: int, polls: list[dict], mix: dict[str, int], duration: float) -> dict:
+    """Sends requests until `duration` seconds have passed, returns the latencies and errors per request kind."""
+    rng = random.Random(number)
+    kinds, weights = list(mix), list(mix.values())
+    latencies: dict[str, list[float]] = {kind: [] for kind in kinds}
+    errors: dict[str, list[str]] = {kind: [] for kind in kinds}
+    deadline = time.monotonic() + duration
+    n = 0
+    while time.monotonic() < deadline:
+        kind = rng.choices(kinds, weights)[0]
+        n += 1
+        start = time.perf_counter()
+        try:
+            status = send(port, kind, rng.choice(polls), f"Load voter {number}-{n}", rng)
+            expected = 302 if kind == "vote" else 200
+            if status != expected:
+                errors[kind].append(f"HTTP {status}")
+                continue
+        except OSError as e:
+            errors[kind].append(repr(e))
+            continue
+        latencies[kind].append(time.perf_counter() - start)
+    return {"latencies": latencies, "errors": errors}
+
+def summarize(kind_latencies: list[float], kind_errors: list[str], duration: float) -> dict:
+    summary: dict = {"requests": len(kind_latencies), "errors": len(kind_errors),
+                     "requests_per_s": len(kind_latencies) / duration}
+    if len(kind_latencies) >= 2:
+        percentiles = statistics.quantiles(kind_latencies, n=100)
+        summary.update(median_ms=statistics.median(kind_latencies) * 1000,
+                       p95_ms=percentiles[94] * 1000,
+                       p99_ms=percentiles[98] * 1000)
+    if len(kind_errors) > 0:
+        summary["first_errors"] = sorted(set(kind_errors))[:5]
+    return summary
+
+def wait_until_ready(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise Exception(f"gunicorn did not answer on port {port} within {timeout}s")
+
+def count_jobs(db_path: str, status_condition: str) -> int:
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(f"SELECT count(*) FROM jobs WHERE {status_condition}").fetchone()[0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shape", type=parse_shape, default=parse_shape("20x20x30"), help="POLLSxCHOICESxVOTERS")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("poll_table=40,poll_list=30,vote=20,manage=10"))
+    parser.add_argument("--drain-timeout", type=float, default=60,
+                        help="Seconds to wait for the queued emails to be sent after the load")
+    args = parser.parse_args()
+
+    smtp_sink = SmtpSink()
+    threading.Thread(target=smtp_sink.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = make_env(tmp_dir)
+        create_database(env)
+        os.environ["DB_PATH"] = env["DB_PATH"]
+        sys.path.insert(0, REPO_DIR)
+        polls: list[SeededPoll] = seed(args.shape, author_email="author@example.com")
+
+        port = free_port()
+        env.update(GUNICORN_BIND=f"127.0.0.1:{port}",
+                   GUNICORN_WORKERS=str(args.workers),
+                   EMAIL_HOST="127.0.0.1",
+                   EMAIL_PORT=str(smtp_sink.server_address[1]),
+                   EMAIL_HOST_USER="bench",
+                   EMAIL_HOST_PASSWORD="bench",
+                   EMAIL_USE_TLS="false",
+                   EMAIL_MESSAGE_FROM="bench@localhost")
+        server = subprocess.Popen(["gunicorn", "-c", "gunicorn.conf.py", "app:app"], cwd=REPO_DIR, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_ready(port, timeout=60)
+
+            start = time.perf_counter()
+            with multiprocessing.get_context("spawn").Pool(args.clients) as pool:
+                client_results = pool.starmap(run_client, [
+                    (number, port, [asdict(poll) for poll in polls], args.mix, args.duration)
+                    for number in range(args.clients)
+                ])
+            duration = time.perf_counter() - start
+
+            drain_start = time.perf_counter()
+            # Failed jobs are kept in the table, only wait for the others
+            pending_jobs = count_jobs(env["DB_PATH"], "status != 'failed'")
+            while pending_jobs > 0 and time.perf_counter() - drain_start < args.drain_timeout:
+                time.sleep(0.1)
+                pending_jobs = count_jobs(env["DB_PATH"], "status != 'failed'")
+            drain_s = time.perf_counter() - drain_start
+            failed_jobs = count_jobs(env["DB_PATH"], "status = 'failed'")
+        finally:
+            server.terminate()
+            server.wait()
+
+    requests = {}
+    for kind in args.mix:
+        kind_latencies = [latency for result in client_results for latency in result["latencies"][kind]]
+        kind_errors = [error for result in client_results for error in result["errors"][kind]]
+        requests[kind] = summarize(kind_latencies, kind_errors, duration)
+    results = {
+        "run": run_info(),
+        "config": {"shape": str(args.shape), "clients": args.clients, "duration_s": args.duration,
+                   "workers": args.workers, "mix": args.mix},
+        "requests_per_s": sum(r["requests_per_s"] for r in requests.values()),
+        "requests": requests,
+        "email": {"votes": requests["vote"]["requests"] if "vote" in requests else 0,
+                  "messages_received": smtp_sink.messages,
+                  "smtp_connections": smtp_sink.connections,
+                  "pending_jobs": pending_jobs,
+                  "failed_jobs": failed_jobs,
+                  "drain_s": drain_s},
+    }
+    smtp_sink.shutdown()
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
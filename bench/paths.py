@@ -0,0 +1,113 @@
+"""Path benchmark: poll queries and page renders for configurable poll shapes.
+
+Usage: python bench/paths.py [--shape 200x10x10 --shape 3x100x300] [--runs 200]
+
+Creates a temporary database with apply_migrations.py and seeds it with
+polls of every shape, given as POLLSxCHOICESxVOTERS. For each shape it times
+db.get_poll (with a cold and a warm poll cache), db.get_poll_summaries_by_codes
+for the manage codes of all its polls, Flask test client renders of
+/poll/<id> in table and list mode and of /manage/<code> (with cold and warm
+caches), and db.vote_poll. Prints the results as JSON, including the commit
+they were measured on.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable
+
+from fixtures import DEFAULT_SHAPES, REPO_DIR, Shape, create_database, make_env, parse_shape, run_info, seed
+
+def measure(run: Callable[[], None], runs: int, before: Callable[[], None] | None = None) -> dict:
+    timings = []
+    for _ in range(runs):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return {"median_ms": statistics.median(timings) * 1000,
+            "p95_ms": statistics.quantiles(timings, n=20)[-1] * 1000,
+            "min_ms": min(timings) * 1000}
+
+def measure_shape(shape: Shape, runs: int) -> dict:
+    import app
+    import compression
+    import db
+
+    rng = random.Random(1)
+    polls = seed(shape)
+    results: dict = {}
+
+    def clear_caches():
+        db.poll_cache.clear()
+        app.vote_grid_cache.clear()
+        compression.compressed_bodies.clear()
+
+    results["get_poll_cold"] = measure(lambda: db.get_poll(rng.choice(polls).id), runs, before=db.poll_cache.clear)
+    results["get_poll_warm"] = measure(lambda: db.get_poll(rng.choice(polls).id), runs)
+
+    codes = [poll.manage_code for poll in polls]
+    results["get_poll_summaries_by_codes"] = measure(
+        lambda: db.get_poll_summaries_by_codes(codes, 1, app.DASHBOARD_PAGE_SIZE), runs)
+
+    client = app.app.test_client()
+    headers = {"Accept-Encoding": "br, gzip"}
+
+    def get(path: str):
+        response = client.get(path, headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"GET {path} returned {response.status_code}")
+
+    for display_mode in ["table", "list"]:
+        client.set_cookie("diddle_display_mode", display_mode)
+        for caches, before in [("cold", clear_caches), ("warm", None)]:
+            results[f"render_poll_{display_mode}_{caches}"] = measure(
+                lambda: get(f"/poll/{rng.choice(polls).id}"), runs, before=before)
+    for caches, before in [("cold", clear_caches), ("warm", None)]:
+        results[f"render_manage_{caches}"] = measure(
+            lambda: get(f"/manage/{rng.choice(polls).manage_code}"), runs, before=before)
+
+    # Last, since every vote adds a voter to the measured polls
+    voter_numbers = iter(range(runs))
+    def vote():
+        poll = rng.choice(polls)
+        result = db.vote_poll(poll.id, f"Bench voter {next(voter_numbers)}",
+                              {choice_id for choice_id in poll.choice_ids if rng.random() < 0.5})
+        if result.error is not None:
+            raise Exception(f"vote_poll failed with {result.error}")
+    results["vote_poll"] = measure(vote, runs)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shape", type=parse_shape, action="append", dest="shapes",
+                        help="POLLSxCHOICESxVOTERS, can be repeated, default: "
+                             + " ".join(f"--shape {shape}" for shape in DEFAULT_SHAPES))
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+    shapes = args.shapes or DEFAULT_SHAPES
+
+    results = {"run": run_info(), "runs": args.runs, "shapes": {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = make_env(tmp_dir)
+        create_database(env)
+        os.environ.clear()
+        os.environ.update(env)
+        sys.path.insert(0, REPO_DIR)
+        os.chdir(REPO_DIR)
+        # The app reports its configuration on stdout, which is reserved for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            for shape in shapes:
+                results["shapes"][str(shape)] = measure_shape(shape, args.runs)
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Startup benchmark: app import time, gunicorn worker boot time and memory per worker.
+
+Usage: python bench/startup.py [--workers 4] [--runs 5]
+
+Runs gunicorn with gunicorn.conf.py, once without and once with preload_app,
+against a temporary database and prints the results as JSON.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from fixtures import REPO_DIR, create_database, make_env
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def measure_import(env: dict[str, str], runs: int) -> dict:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import app"], cwd=REPO_DIR, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return {"runs": runs, "median_s": statistics.median(timings), "min_s": min(timings)}
+
+def read_memory_kb(pid: int) -> dict[str, int]:
+    memory = {}
+    for path, fields in [(f"/proc/{pid}/status", ["VmRSS"]), (f"/proc/{pid}/smaps_rollup", ["Pss"])]:
+        try:
+            with open(path) as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    if key in fields:
+                        memory[key.lower() + "_kb"] = int(value.split()[0])
+        except OSError:
+            pass
+    return memory
+
+def measure_gunicorn(env: dict[str, str], tmp_dir: str, workers: int, preload: bool) -> dict:
+    boot_log = os.path.join(tmp_dir, f"boot_{preload}.log")
+    config_path = os.path.join(tmp_dir, f"gunicorn_{preload}.conf.py")
+    with open(config_path, "w") as f:
+        f.write(f"exec(open({os.path.join(REPO_DIR, 'gunicorn.conf.py')!r}).read())\n"
+                "import os, time\n"
+                "def post_worker_init(worker):\n"
+                f"    with open({boot_log!r}, 'a') as log:\n"
+                "        log.write(f'{os.getpid()} {time.time()}\\n')\n")
+
+    port = free_port()
+    env = dict(env,
+               GUNICORN_BIND=f"127.0.0.1:{port}",
+               GUNICORN_WORKERS=str(workers),
+               GUNICORN_PRELOAD="true" if preload else "false")
+    start = time.time()
+    proc = subprocess.Popen(["gunicorn", "-c", config_path, "app:app"], cwd=REPO_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first_response_s = None
+        boots: list[tuple[int, float]] = []
+        deadline = time.time() + 60
+        while time.time() < deadline and (first_response_s is None or len(boots) < workers):
+            if first_response_s is None:
+                try:
+                    urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1).read()
+                    first_response_s = time.time() - start
+                except OSError:
+                    pass
+            if os.path.exists(boot_log):
+                with open(boot_log) as log:
+                    boots = [(int(pid), float(ts)) for pid, ts in (line.split() for line in log if line.strip())]
+            time.sleep(0.01)
+
+        return {
+            "preload": preload,
+            "workers": workers,
+            "first_response_s": first_response_s,
+            "all_workers_booted_s": max(ts for _, ts in boots) - start if len(boots) >= workers else None,
+            "master_memory": read_memory_kb(proc.pid),
+            "worker_memory": [read_memory_kb(pid) for pid, _ in boots],
+        }
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = make_env(tmp_dir)
+        create_database(env)
+        results = {
+            "import_app": measure_import(env, args.runs),
+            "gunicorn": [measure_gunicorn(env, tmp_dir, args.workers, preload) for preload in (False, True)],
+        }
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""Storage benchmark: database size and poll query times across the storage schema migrations.
+
+Usage: python bench/storage.py [--polls 200] [--choices 20] [--voters 30] [--runs 500]
+
+Seeds a temporary database with the schema of the migrations before
+0006_compact_schema.sql and measures it. Then applies 0006_compact_schema.sql
+and 0007_vote_bitmaps.py one at a time and measures again after each. Prints
+the results as JSON.
+"""
+import argparse
+import json
+import os
+import random
+import runpy
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIGRATIONS_DIR = os.path.join(REPO_DIR, "migrations")
+sys.path.insert(0, REPO_DIR)
+
+# Migration numbers of the measured schemas after the initial one
+SCHEMA_MIGRATIONS = {"compact": 6, "bitmaps": 7}
+
+# Queries of the page load and vote paths, per schema. Every query takes the
+# public poll id, choice-related queries are covered by load_poll.
+QUERIES = {
+    "initial": {
+        "load_poll": [
+            "SELECT * FROM polls WHERE id = :poll_id",
+            "SELECT * FROM choices WHERE poll_id = :poll_id ORDER BY start_datetime",
+            "SELECT * FROM votes WHERE poll_id = :poll_id ORDER BY voter_name",
+        ],
+        "voter_name_in_use": [
+            "SELECT EXISTS (SELECT 1 FROM votes WHERE poll_id = :poll_id AND voter_name = :voter_name)",
+        ],
+        "voter_by_manage_code": [
+            "SELECT voter_name FROM votes WHERE manage_code = :manage_code",
+        ],
+    },
+    "compact": {
+        "load_poll": [
+            "SELECT * FROM polls WHERE uuid = :poll_id",
+            "SELECT choices.id, choices.uuid, start_datetime, end_datetime, yes_count FROM choices "
+            "WHERE poll_id = (SELECT id FROM polls WHERE uuid = :poll_id) ORDER BY start_datetime",
+            "SELECT votes.choice_id, voters.name, voters.manage_code, votes.value "
+            "FROM voters JOIN votes ON votes.voter_id = voters.id "
+            "WHERE voters.poll_id = (SELECT id FROM polls WHERE uuid = :poll_id) ORDER BY voters.name",
+        ],
+        "voter_name_in_use": [
+            "SELECT EXISTS (SELECT 1 FROM voters WHERE poll_id = (SELECT id FROM polls WHERE uuid = :poll_id) "
+            "AND name = :voter_name)",
+        ],
+        "voter_by_manage_code": [
+            "SELECT name FROM voters WHERE manage_code = :manage_code",
+        ],
+    },
+    "bitmaps": {
+        "load_poll": [
+            "SELECT * FROM polls WHERE uuid = :poll_id",
+            "SELECT slot, uuid, start_datetime, end_datetime FROM choices "
+            "WHERE poll_id = (SELECT id FROM polls WHERE uuid = :poll_id) ORDER BY start_datetime",
+            "SELECT name, manage_code, votes, slot_count FROM voters "
+            "WHERE poll_id = (SELECT id FROM polls WHERE uuid = :poll_id) ORDER BY name",
+        ],
+        "voter_name_in_use": [
+            "SELECT EXISTS (SELECT 1 FROM voters WHERE poll_id = (SELECT id FROM polls WHERE uuid = :poll_id) "
+            "AND name = :voter_name)",
+        ],
+        "voter_by_manage_code": [
+            "SELECT name FROM voters WHERE manage_code = :manage_code",
+        ],
+    },
+}
+
+def apply_migrations(conn: sqlite3.Connection, numbers: range) -> None:
+    for name in sorted(os.listdir(MIGRATIONS_DIR)):
+        path = os.path.join(MIGRATIONS_DIR, name)
+        if name.endswith(".sql") and int(name.split("_")[0]) in numbers:
+            with open(path) as f:
+                conn.executescript(f.read())
+        elif name.endswith(".py") and int(name.split("_")[0]) in numbers:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            runpy.run_path(path)["migrate"](cur)
+            cur.execute("COMMIT")
+
+def seed(conn: sqlite3.Connection, polls: int, choices: int, voters: int) -> list[dict]:
+    """Fills the pre-0006 schema and returns the parameters for the timed queries."""
+    samples = []
+    for i in range(polls):
+        poll_id = conn.execute("INSERT INTO polls (title, author_name, whole_day, updated_at) "
+                               "VALUES (?, 'Author', 0, CURRENT_TIMESTAMP) RETURNING id",
+                               (f"Poll {i}",)).fetchone()[0]
+        choice_ids = [
+            conn.execute("INSERT INTO choices (poll_id, start_datetime, end_datetime) VALUES (?, ?, ?) RETURNING id",
+                         (poll_id, f"2030-01-{1 + j % 28:02d} {j % 24:02d}:00:00",
+                          f"2030-01-{1 + j % 28:02d} {j % 24:02d}:30:00")).fetchone()[0]
+            for j in range(choices)
+        ]
+        for j in range(voters):
+            manage_code = str(uuid.uuid4())
+            conn.executemany("INSERT INTO votes (poll_id, choice_id, voter_name, value, manage_code) VALUES (?, ?, ?, ?, ?)",
+                             [(poll_id, choice_id, f"Voter {j}", random.randint(0, 1), manage_code)
+                              for choice_id in choice_ids])
+            if j == 0:
+                samples.append({"poll_id": poll_id, "voter_name": f"Voter {j}", "manage_code": manage_code})
+    conn.commit()
+    return samples
+
+def database_size(conn: sqlite3.Connection) -> dict[str, int]:
+    conn.execute("VACUUM")
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return {"bytes": page_count * page_size, "pages": page_count}
+
+def time_queries(conn: sqlite3.Connection, queries: dict[str, list[str]], samples: list[dict], runs: int) -> dict:
+    results = {}
+    for name, statements in queries.items():
+        timings = []
+        for _ in range(runs):
+            params = random.choice(samples)
+            start = time.perf_counter()
+            for statement in statements:
+                conn.execute(statement, params).fetchall()
+            timings.append(time.perf_counter() - start)
+        results[name] = {"median_ms": statistics.median(timings) * 1000, "p95_ms": statistics.quantiles(timings, n=20)[-1] * 1000}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--polls", type=int, default=200)
+    parser.add_argument("--choices", type=int, default=20)
+    parser.add_argument("--voters", type=int, default=30)
+    parser.add_argument("--runs", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ["DB_PATH"] = os.path.join(tmp_dir, "db.sqlite3")
+        conn = sqlite3.connect(os.environ["DB_PATH"], isolation_level=None)
+        apply_migrations(conn, range(SCHEMA_MIGRATIONS["compact"]))
+        conn.isolation_level = ""
+        samples = seed(conn, args.polls, args.choices, args.voters)
+        conn.isolation_level = None
+
+        results = {"shape": vars(args)}
+        results["initial"] = {"size": database_size(conn),
+                              "queries": time_queries(conn, QUERIES["initial"], samples, args.runs)}
+
+        for schema, number in SCHEMA_MIGRATIONS.items():
+            start = time.perf_counter()
+            apply_migrations(conn, range(number, number + 1))
+            results[schema] = {"migration_s": time.perf_counter() - start,
+                               "size": database_size(conn),
+                               "queries": time_queries(conn, QUERIES[schema], samples, args.runs)}
+        conn.close()
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
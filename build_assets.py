@@ -0,0 +1,81 @@
+"""Builds fingerprinted, precompressed static assets into static/dist.
+
+Every asset is written as <name>.<content hash>.<ext> together with .br and
+.gz variants where compression helps, and static/dist/manifest.json maps the
+original names to the built ones (see asset_url in app.py). The font is
+subset to Latin scripts and converted to WOFF2.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+import brotli
+from fontTools import subset
+
+static_dir = "static"
+dist_dir = os.path.join(static_dir, "dist")
+
+FONT = "InclusiveSans-Regular.ttf"
+STYLESHEET = "styles.css"
+
+# Basic Latin, Latin-1 Supplement, Latin Extended-A/B, General Punctuation,
+# and a few common symbols (euro, trademark, arrows, minus)
+FONT_UNICODES = "U+0000-024F,U+02BB-02BC,U+02C6,U+02DA,U+02DC,U+2000-206F,U+20AC,U+2122,U+2190-2193,U+2212,U+FEFF,U+FFFD"
+
+def write_asset(name: str, data: bytes, compress: bool) -> str:
+  """Writes data under a content-hashed file name and returns that name."""
+  stem, ext = os.path.splitext(name)
+  content_hash = hashlib.sha256(data).hexdigest()[:12]
+  built_name = f"{stem}.{content_hash}{ext}"
+  path = os.path.join(dist_dir, built_name)
+
+  with open(path, "wb") as f:
+    f.write(data)
+  if compress:
+    with open(path + ".br", "wb") as f:
+      f.write(brotli.compress(data, quality=11))
+    with open(path + ".gz", "wb") as f:
+      f.write(gzip.compress(data, compresslevel=9, mtime=0))
+
+  print(f"* {name} -> {built_name} ({len(data)} bytes)")
+  return built_name
+
+def build_font() -> bytes:
+  options = subset.Options()
+  options.flavor = "woff2"
+  options.layout_features = ["*"]
+  font = subset.load_font(os.path.join(static_dir, FONT), options)
+  subsetter = subset.Subsetter(options)
+  subsetter.populate(unicodes=subset.parse_unicodes(FONT_UNICODES))
+  subsetter.subset(font)
+
+  out_path = os.path.join(dist_dir, "font.tmp")
+  subset.save_font(font, out_path, options)
+  with open(out_path, "rb") as f:
+    data = f.read()
+  os.remove(out_path)
+  return data
+
+shutil.rmtree(dist_dir, ignore_errors=True)
+os.makedirs(dist_dir)
+
+manifest: dict[str, str] = {}
+
+# WOFF2 is already Brotli-compressed internally
+font_name = write_asset(os.path.splitext(FONT)[0] + ".woff2", build_font(), compress=False)
+manifest[FONT] = font_name
+
+with open(os.path.join(static_dir, STYLESHEET), "r") as f:
+  stylesheet = f.read()
+original_font_src = f"url(/static/{FONT})"
+if original_font_src not in stylesheet:
+  raise Exception(f"{STYLESHEET} does not reference {original_font_src}")
+stylesheet = stylesheet.replace(original_font_src, f"url(/static/dist/{font_name})")
+manifest[STYLESHEET] = write_asset(STYLESHEET, stylesheet.encode(), compress=True)
+
+with open(os.path.join(dist_dir, "manifest.json"), "w") as f:
+  json.dump(manifest, f, indent=2)
+
+print(f"* {len(manifest)} assets built into {dist_dir}")
@@ -0,0 +1,131 @@
+"""Response compression with per-view policies.
+
+Views pick their policy with the `policy` decorator, everything else is
+compressed with DEFAULT_POLICY. Compressed bodies of responses with an ETag
+can be cached and reused, so that a page that is served again unchanged is
+not compressed again.
+"""
+import gzip
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, replace
+from typing import Callable
+
+from flask import Response, request
+
+import metrics
+from cache import LruCache
+
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "500"))
+# Low levels by default: on large poll pages Brotli quality 1 is about five
+# times faster than quality 4 for a body about a third larger
+COMPRESS_BR_LEVEL = int(os.environ.get("COMPRESS_BR_LEVEL", "1"))
+COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", "1"))
+COMPRESS_CACHE_MAX_BYTES = int(os.environ.get("COMPRESS_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+COMPRESSIBLE_MIMETYPES = {
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/xml",
+    "text/csv",
+    "text/calendar",
+    "application/json",
+    "application/javascript",
+}
+# In order of preference
+ENCODINGS = ["br", "gzip"]
+
+@dataclass(frozen=True)
+class CompressionPolicy:
+    enabled: bool = True
+    min_size: int = COMPRESS_MIN_SIZE
+    br_level: int = COMPRESS_BR_LEVEL
+    gzip_level: int = COMPRESS_GZIP_LEVEL
+    # Reuse compressed bodies of responses with the same ETag. Only for views
+    # whose ETag covers everything the body depends on.
+    cache: bool = False
+
+DEFAULT_POLICY = CompressionPolicy()
+
+def policy(**overrides) -> Callable:
+    """Sets the compression policy of a view, e.g. @compression.policy(cache=True)."""
+    def decorate(view):
+        view.compression_policy = replace(DEFAULT_POLICY, **overrides)
+        return view
+    return decorate
+
+@dataclass
+class CompressionStats:
+    compressions: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    cpu_seconds: float = 0.0
+    cache_hits: int = 0
+
+stats_lock = threading.Lock()
+stats_by_encoding = {encoding: CompressionStats() for encoding in ENCODINGS}
+
+# Compressed bodies keyed by ETag, encoding and level, weighted by size
+compressed_bodies: LruCache[bytes] = LruCache(max_weight=COMPRESS_CACHE_MAX_BYTES)
+
+def stats() -> dict[str, dict]:
+    with stats_lock:
+        return {encoding: asdict(s) for encoding, s in stats_by_encoding.items()}
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    start = time.perf_counter()
+    start_cpu = time.thread_time()
+    if encoding == "br":
+        import brotli
+        compressed = brotli.compress(data, quality=level)
+    else:
+        compressed = gzip.compress(data, compresslevel=level, mtime=0)
+    cpu_seconds = time.thread_time() - start_cpu
+    metrics.add_time("compression_seconds", time.perf_counter() - start)
+
+    with stats_lock:
+        s = stats_by_encoding[encoding]
+        s.compressions += 1
+        s.bytes_in += len(data)
+        s.bytes_out += len(compressed)
+        s.cpu_seconds += cpu_seconds
+    return compressed
+
+def negotiated_encoding() -> str | None:
+    """The content coding of compressed responses to the current request, None if it accepts none."""
+    return request.accept_encodings.best_match(ENCODINGS)
+
+def compress_response(response: Response, policy: CompressionPolicy) -> Response:
+    if not policy.enabled or response.direct_passthrough or response.is_streamed:
+        return response
+    if not 200 <= response.status_code < 300 or "Content-Encoding" in response.headers:
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    if response.content_length is not None and response.content_length < policy.min_size:
+        return response
+    encoding = negotiated_encoding()
+    if encoding is None:
+        return response
+
+    level = policy.br_level if encoding == "br" else policy.gzip_level
+    etag, weak = response.get_etag()
+    key = (etag, encoding, level)
+    body = compressed_bodies.get(key) if policy.cache and etag else None
+    if body is None:
+        body = compress(response.get_data(), encoding, level)
+        if policy.cache and etag:
+            compressed_bodies.put(key, body, weight=len(body))
+    else:
+        with stats_lock:
+            stats_by_encoding[encoding].cache_hits += 1
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    if etag:
+        response.set_etag(f"{etag}:{encoding}", weak=weak)
+    return response
@@ -1,63 +1,273 @@
 import os
-from typing import List, Optional, Tuple, cast
+from typing import Callable, FrozenSet, Iterable, Iterator, List, Optional, Tuple, TypeVar, cast
+from concurrent.futures import Future
+from contextlib import contextmanager
 from dataclasses import dataclass
 import datetime
+import json
+import queue
 import sqlite3
+import sys
+import threading
+import time
+import traceback
 import uuid
 
+import metrics
+from cache import LruCache
+
 BASE_URL = os.environ.get("BASE_URL", "http://localhost")
 DB_PATH = os.environ.get("DB_PATH", "db.sqlite3")
 DB_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+# One connection per thread using the database by default: the gunicorn
+# threads, the job threads, the job worker loop and the write batcher
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", str(int(os.environ.get("GUNICORN_THREADS", "16"))
+                                                      + int(os.environ.get("JOB_WORKERS", "4")) + 2)))
+POLL_CACHE_MAX_ROWS = int(os.environ.get("POLL_CACHE_MAX_ROWS", "200000"))
+POLL_CACHE_TTL = float(os.environ.get("POLL_CACHE_TTL", "300"))
+WRITE_BATCHING = os.environ.get("WRITE_BATCHING", "false").lower() in ["true", "1", "yes"]
+WRITE_BATCH_MAX_SIZE = int(os.environ.get("WRITE_BATCH_MAX_SIZE", "64"))
+WRITE_BATCH_MAX_DELAY_MS = float(os.environ.get("WRITE_BATCH_MAX_DELAY_MS", "0"))
+
+# Connection-level settings are not persisted in the database file, so every
+# connection has to apply them itself. journal_mode = WAL is persistent and is
+# set by the initial migration.
+CONNECTION_PRAGMAS = [
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = 1000000000",
+    "PRAGMA foreign_keys = true",
+    "PRAGMA temp_store = memory",
+]
+
+# Poll changes made by the transactions open on this thread, innermost last,
+# see _bump_poll_version
+open_transactions = threading.local()
+
 class DbContextManager:
     def __init__(self, db: "Db"):
         self.db = db
         self.conn = None
         self.cursor = None
+        self.poll_changes: List["PollChange"] = []
 
     def __enter__(self):
-        self.conn = self.db.connect()
+        self.conn = self.db.acquire()
         self.cursor = self.conn.cursor()
+        if not hasattr(open_transactions, "stack"):
+            open_transactions.stack = []
+        open_transactions.stack.append(self.poll_changes)
         return self.conn, self.cursor
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         conn: sqlite3.Connection = cast(sqlite3.Connection, self.conn)
-        if exc_type:
-            conn.rollback()
-        else:
-            conn.commit()
+        open_transactions.stack.pop()
+        healthy = True
+        try:
+            if exc_type:
+                conn.rollback()
+            else:
+                conn.commit()
+        except sqlite3.Error:
+            healthy = False
+            raise
+        finally:
+            if self.cursor:
+                self.cursor.close()
+            self.db.release(conn, healthy=healthy)
+
+        if not exc_type:
+            notify_poll_changes(self.poll_changes)
 
-        if self.cursor:
-            self.cursor.close()
-        if self.conn:
-            self.conn.close()
+@dataclass
+class PoolStats:
+    opened: int = 0
+    reused: int = 0
+    closed: int = 0
 
 class Db:
-    def __init__(self):
-        pass
+    """Hands out SQLite connections from a small per-process pool.
 
-    def connect(self):
+    Connections are configured once when they are opened and then reused
+    across requests. At most `pool_size` idle connections are kept around;
+    connections returned while the pool is full are closed.
+    """
+
+    def __init__(self, pool_size: int = DB_POOL_SIZE):
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.idle: List[sqlite3.Connection] = []
+        self.in_use = 0
+        self.pid = os.getpid()
+        self.stats = PoolStats()
+
+    def connect(self) -> sqlite3.Connection:
         conn = sqlite3.connect(
             DB_PATH,
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
             isolation_level="IMMEDIATE",
+            check_same_thread=False,
         )
         conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        metrics.count_connection_opened()
+        if metrics.METRICS_ENABLED:
+            conn.set_trace_callback(metrics.count_sql_statement)
         return conn
 
+    def acquire(self) -> sqlite3.Connection:
+        with self.lock:
+            if self.pid != os.getpid():
+                # Connections must not be shared with a forked child (e.g. a
+                # gunicorn worker forked from a preloaded master)
+                self.idle = []
+                self.in_use = 0
+                self.pid = os.getpid()
+
+            self.in_use += 1
+            if self.idle:
+                self.stats.reused += 1
+                return self.idle.pop()
+            self.stats.opened += 1
+
+        try:
+            return self.connect()
+        except BaseException:
+            with self.lock:
+                self.in_use -= 1
+                self.stats.opened -= 1
+            raise
+
+    def release(self, conn: sqlite3.Connection, healthy: bool = True) -> None:
+        with self.lock:
+            self.in_use -= 1
+            if healthy and self.pid == os.getpid() and len(self.idle) < self.pool_size:
+                self.idle.append(conn)
+                return
+            self.stats.closed += 1
+
+        conn.close()
+
+    def pool_stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "size": self.pool_size,
+                "idle": len(self.idle),
+                "in_use": self.in_use,
+                "opened": self.stats.opened,
+                "reused": self.stats.reused,
+                "closed": self.stats.closed,
+            }
+
     def cursor(self):
         return DbContextManager(db=self)
 
 db = Db()
 
+### Writes
+
+T = TypeVar("T")
+
+WRITE_BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+metrics.describe("diddle_write_commit_seconds", "histogram", "Time from BEGIN to COMMIT of batched write transactions")
+metrics.describe("diddle_write_batch_size", "histogram", "Number of writes committed together by a batched write transaction")
+
+class WriteBatcher:
+    """Commits the writes of all threads of a process together (group commit).
+
+    Threads submit write operations and wait for their results. A writer
+    thread takes the operations waiting at that moment, up to `max_size`,
+    waiting at most `max_delay` seconds for more, and runs them in a single
+    IMMEDIATE transaction. Each operation runs in a savepoint, so one that
+    raises is rolled back alone and its exception raised in its thread,
+    while the others commit. A burst of votes thus takes the write lock and
+    syncs the WAL once per batch instead of once per vote.
+    """
+
+    def __init__(self, max_size: int, max_delay: float):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.queue: queue.SimpleQueue[Tuple[Callable[[sqlite3.Cursor], object], Future]] = queue.SimpleQueue()
+        self.pid: Optional[int] = None
+
+    def submit(self, op: Callable[[sqlite3.Cursor], T]) -> T:
+        with self.lock:
+            # Threads do not survive fork, start the writer in every worker process
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = queue.SimpleQueue()
+                threading.Thread(target=self.run, args=(self.queue,), daemon=True).start()
+            ops = self.queue
+        future: Future = Future()
+        ops.put((op, future))
+        return future.result()
+
+    def run(self, ops: queue.SimpleQueue) -> None:
+        while True:
+            batch = [ops.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_size:
+                try:
+                    timeout = deadline - time.monotonic()
+                    batch.append(ops.get(timeout=timeout) if timeout > 0 else ops.get_nowait())
+                except queue.Empty:
+                    break
+            self.run_batch(batch)
+
+    def run_batch(self, batch: List[Tuple[Callable[[sqlite3.Cursor], object], Future]]) -> None:
+        outcomes = []
+        start = time.perf_counter()
+        try:
+            with db.cursor() as (conn, cur):
+                cur.execute("BEGIN IMMEDIATE")
+                poll_changes = open_transactions.stack[-1]
+                for op, future in batch:
+                    changes_before = len(poll_changes)
+                    cur.execute("SAVEPOINT write_op")
+                    try:
+                        outcomes.append((future, op(cur), None))
+                    except Exception as e:
+                        cur.execute("ROLLBACK TO write_op")
+                        del poll_changes[changes_before:]
+                        outcomes.append((future, None, e))
+                    cur.execute("RELEASE write_op")
+        except Exception as e:
+            # Nothing of the batch is committed
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        metrics.observe("diddle_write_commit_seconds", time.perf_counter() - start)
+        metrics.observe("diddle_write_batch_size", len(batch), buckets=WRITE_BATCH_SIZE_BUCKETS)
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+write_batcher = WriteBatcher(WRITE_BATCH_MAX_SIZE, WRITE_BATCH_MAX_DELAY_MS / 1000)
+
+def run_write(op: Callable[[sqlite3.Cursor], T]) -> T:
+    """Runs op in an IMMEDIATE transaction, shared with the writes of other threads with WRITE_BATCHING.
+
+    Taking the write lock before op runs makes the checks op does hold until
+    commit. The poll changes op makes are notified once it has committed.
+    """
+    if WRITE_BATCHING:
+        return write_batcher.submit(op)
+    with db.cursor() as (conn, cur):
+        cur.execute("BEGIN IMMEDIATE")
+        return op(cur)
+
 @dataclass
-class Vote:
-    id: str
-    poll_id: str
-    choice_id: str
-    voter_name: str
-    value: int  # 0 or 1
+class Voter:
+    name: str
     manage_code: str
+    # Choices the voter has a vote on, choices added after they voted have none
+    voted_choice_ids: FrozenSet[str]
+    yes_choice_ids: FrozenSet[str]
 
 @dataclass
 class Choice:
@@ -65,7 +275,8 @@ class Choice:
     poll_id: str
     start_datetime: datetime.datetime
     end_datetime: datetime.datetime
-    votes: List[Vote]
+    yes_count: int
+    yes_voter_names: List[str]
 
     def start_datetime_notz(self) -> datetime.datetime:
         return self.start_datetime.replace(tzinfo=None)
@@ -85,9 +296,6 @@ class Choice:
     def ends_at_same_datetime(self) -> bool:
         return self.start_datetime == self.end_datetime
 
-    def votes_with_value(self, value: int) -> List[Vote]:
-        return [vote for vote in self.votes if vote.value == value]
-
 @dataclass
 class Poll:
     id: str
@@ -97,159 +305,727 @@ class Poll:
     author_name: str
     author_email: Optional[str]
     choices: List[Choice]
+    voters: List[Voter]
     manage_code: str
     is_whole_day: bool
+    version: int
+    updated_at: datetime.datetime
 
     def pub_date_formatted_notz(self) -> str:
         date = self.pub_date.replace(tzinfo=None).strftime("%d.%m.%Y")
         time = self.pub_date.replace(tzinfo=None).strftime("%H:%M")
         return f"Created on {date} at {time}"
 
+    def most_voted_choice_ids(self) -> set[str]:
+        """Returns the ids of the choices with the most votes with value 1, if any choice has such votes."""
+        most_voted_value = max((choice.yes_count for choice in self.choices), default=0)
+        if most_voted_value == 0:
+            return set()
+        return {choice.id for choice in self.choices if choice.yes_count == most_voted_value}
+
     def share_url(self) -> str:
         return f"{BASE_URL}/poll/{self.id}"
 
     def manage_url(self) -> str:
         return f"{BASE_URL}/manage/{self.manage_code}"
 
+def parse_db_datetime(value: str) -> datetime.datetime:
+    """Parses a DB_DATE_FORMAT timestamp, much faster than strptime."""
+    return datetime.datetime.fromisoformat(value)
+
+# Public columns of polls in the order expected by tuple_to_poll
+POLL_COLUMNS = "uuid, title, description, pub_date, author_name, author_email, manage_code, whole_day, version, updated_at"
+
 def tuple_to_poll(poll_t: Tuple) -> Poll:
     return Poll(
         id=poll_t[0],
         title=poll_t[1],
         description=poll_t[2],
-        pub_date=datetime.datetime.strptime(poll_t[3], DB_DATE_FORMAT),
+        pub_date=parse_db_datetime(poll_t[3]),
         author_name=poll_t[4],
         author_email=poll_t[5],
         manage_code=poll_t[6],
         is_whole_day=poll_t[7],
-        choices=[]
+        version=poll_t[8],
+        updated_at=parse_db_datetime(poll_t[9]),
+        choices=[],
+        voters=[]
     )
 
-def tuple_to_choice(choice_t: Tuple) -> Choice:
+def tuple_to_choice(choice_t: Tuple, poll_id: str) -> Choice:
+    """Maps a (uuid, start_datetime, end_datetime) row. yes_count is filled in by _load_poll."""
     return Choice(
         id=choice_t[0],
-        poll_id=choice_t[1],
-        start_datetime=datetime.datetime.strptime(choice_t[2], DB_DATE_FORMAT),
-        end_datetime=datetime.datetime.strptime(choice_t[3], DB_DATE_FORMAT),
-        votes=[]
+        poll_id=poll_id,
+        start_datetime=parse_db_datetime(choice_t[1]),
+        end_datetime=parse_db_datetime(choice_t[2]),
+        yes_count=0,
+        yes_voter_names=[]
     )
 
-def tuple_to_vote(vote_t: Tuple) -> Vote:
-    return Vote(
-        id=vote_t[0],
-        manage_code=vote_t[1],
-        poll_id=vote_t[2],
-        choice_id=vote_t[3],
-        voter_name=vote_t[4],
-        value=vote_t[5],
-    )
+# The votes of a voter are stored as a bitmap on the voters row: bit `slot` is
+# set if the voter voted 1 on the choice with that slot. Slots are assigned
+# per poll from polls.next_slot and never reused, so adding or deleting a
+# choice does not move any bits. Choices with a slot at or above the voter's
+# slot_count were added after the voter voted and have no vote.
 
-def get_poll(id: str) -> Optional[Poll]:
+def blob_to_bitmap(blob: bytes) -> int:
+    return int.from_bytes(blob, "little")
+
+def bitmap_to_blob(bitmap: int, slot_count: int) -> bytes:
+    return bitmap.to_bytes((slot_count + 7) // 8, "little")
+
+def count_bits_by_slot(bitmaps: Iterable[int], slots: Iterable[int]) -> dict[int, int]:
+    """Counts, for each of the slots, how many of the bitmaps have that bit set.
+
+    The bitmaps are summed with bit-sliced counters: bit s of counters[i] is
+    bit i of the count for slot s, so every addition covers all slots at once.
+    """
+    counters: List[int] = []
+    for bitmap in bitmaps:
+        carry = bitmap
+        for i in range(len(counters)):
+            if carry == 0:
+                break
+            counters[i], carry = counters[i] ^ carry, counters[i] & carry
+        if carry != 0:
+            counters.append(carry)
+
+    return {slot: sum(((counter >> slot) & 1) << i for i, counter in enumerate(counters)) for slot in slots}
+
+def _load_poll(cur: sqlite3.Cursor, id: str) -> Optional[Poll]:
+    cur.execute(f"SELECT id, {POLL_COLUMNS} FROM polls WHERE uuid = ?", (id,))
+    poll_t = cur.fetchone()
+    if poll_t is None:
+        return None
+
+    poll_pk = poll_t[0]
+    cur.execute("SELECT slot, uuid, start_datetime, end_datetime FROM choices "
+                "WHERE poll_id = ? ORDER BY start_datetime",
+                (poll_pk,))
+    choice_ts = cur.fetchall()
+
+    cur.execute("SELECT name, manage_code, votes, slot_count FROM voters WHERE poll_id = ? ORDER BY name", (poll_pk,))
+    voter_ts = cur.fetchall()
+
+    with metrics.timed("mapper_seconds"):
+        return _rows_to_poll(poll_t[1:], choice_ts, voter_ts)
+
+def _rows_to_poll(poll_t: Tuple, choice_ts: List[Tuple], voter_ts: List[Tuple]) -> Poll:
+    poll = tuple_to_poll(poll_t)
+    slotted_choices: List[Tuple[int, Choice]] = []
+    for choice_t in choice_ts:
+        choice = tuple_to_choice(choice_t[1:], poll.id)
+        slotted_choices.append((choice_t[0], choice))
+        poll.choices.append(choice)
+
+    # Voters with the same slot_count have a vote on the same choices
+    choices_by_slot = dict(slotted_choices)
+    voted_choice_ids_by_slot_count: dict[int, FrozenSet[str]] = {}
+    for voter_name, manage_code, votes, slot_count in voter_ts:
+        voted_choice_ids = voted_choice_ids_by_slot_count.get(slot_count)
+        if voted_choice_ids is None:
+            voted_choice_ids = frozenset(choice.id for slot, choice in slotted_choices if slot < slot_count)
+            voted_choice_ids_by_slot_count[slot_count] = voted_choice_ids
+
+        yes_choice_ids = set()
+        bitmap = blob_to_bitmap(votes)
+        while bitmap:
+            low_bit = bitmap & -bitmap
+            choice = choices_by_slot.get(low_bit.bit_length() - 1)
+            if choice is not None:
+                choice.yes_voter_names.append(voter_name)
+                yes_choice_ids.add(choice.id)
+            bitmap ^= low_bit
+
+        poll.voters.append(Voter(name=voter_name, manage_code=manage_code,
+                                 voted_choice_ids=voted_choice_ids, yes_choice_ids=frozenset(yes_choice_ids)))
+
+    for choice in poll.choices:
+        choice.yes_count = len(choice.yes_voter_names)
+
+    return poll
+
+# Assembled polls shared by all threads of a worker process. Cached polls must
+# be treated as read-only. Entries are validated against polls.version on every
+# read, which keeps them correct across worker processes.
+poll_cache: LruCache[Poll] = LruCache(max_weight=POLL_CACHE_MAX_ROWS, ttl=POLL_CACHE_TTL)
+
+def _poll_cache_weight(poll: Poll) -> int:
+    return 1 + len(poll.choices) + len(poll.voters)
+
+def _get_cached_poll(cur: sqlite3.Cursor, id: str, version: int) -> Optional[Poll]:
+    poll = poll_cache.get(id)
+    if poll is not None and poll.version == version:
+        return poll
+
+    poll = _load_poll(cur, id)
+    if poll is not None:
+        poll_cache.put(id, poll, weight=_poll_cache_weight(poll))
+    return poll
+
+POLL_CHANGE_VOTE = "vote"
+POLL_CHANGE_VOTER_DELETED = "voter_deleted"
+POLL_CHANGE_CHOICES = "choices"
+POLL_CHANGE_INFO = "info"
+POLL_CHANGE_DELETED = "deleted"
+# Changes a listener has missed, e.g. while it was disconnected
+POLL_CHANGE_UNKNOWN = "unknown"
+
+@dataclass
+class PollChange:
+    poll_id: str
+    version: int
+    kind: str  # one of the POLL_CHANGE_ constants
+    voter_name: Optional[str] = None
+
+# Called with the changes of every transaction after it has committed, e.g. notify.publish
+poll_change_listeners: List[Callable[[PollChange], None]] = []
+
+def notify_poll_changes(changes: List[PollChange]) -> None:
+    for change in changes:
+        for listener in poll_change_listeners:
+            try:
+                listener(change)
+            except Exception:
+                # The change is committed already, so the request goes on
+                traceback.print_exc(file=sys.stderr)
+
+def _bump_poll_version(cur: sqlite3.Cursor, poll_pk: int, kind: str, voter_name: Optional[str] = None) -> None:
+    cur.execute("UPDATE polls SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = ? RETURNING uuid, version",
+                (poll_pk,))
+    for poll_t in cur.fetchall():
+        poll_cache.delete(poll_t[0])
+        open_transactions.stack[-1].append(PollChange(poll_t[0], poll_t[1], kind, voter_name))
+
+@dataclass
+class PollVersion:
+    id: str
+    version: int
+    updated_at: datetime.datetime
+
+def get_poll_version(id: str) -> Optional[PollVersion]:
+    """Returns the version stamp of a poll without loading it."""
     with db.cursor() as (conn, cur):
-        cur.execute("SELECT * FROM polls WHERE id = ?", (id,))
+        cur.execute("SELECT uuid, version, updated_at FROM polls WHERE uuid = ?", (id,))
         poll_t = cur.fetchone()
-        if poll_t is None:
-            return None
+        return PollVersion(poll_t[0], poll_t[1], parse_db_datetime(poll_t[2])) if poll_t else None
 
-        poll = tuple_to_poll(poll_t)
-        cur.execute("SELECT * FROM choices WHERE poll_id = ? ORDER BY start_datetime", (id,))
-        choice_ts = cur.fetchall()
+def get_poll_version_by_code(code: str) -> Optional[PollVersion]:
+    """Returns the version stamp of a poll without loading it."""
+    with db.cursor() as (conn, cur):
+        cur.execute("SELECT uuid, version, updated_at FROM polls WHERE manage_code = ?", (code,))
+        poll_t = cur.fetchone()
+        return PollVersion(poll_t[0], poll_t[1], parse_db_datetime(poll_t[2])) if poll_t else None
 
-        cur.execute("SELECT * FROM votes WHERE poll_id = ? ORDER BY voter_name", (id,))
-        vote_ts = cur.fetchall()
+def get_poll(id: str) -> Optional[Poll]:
+    with db.cursor() as (conn, cur):
+        # Read the version and the poll from the same snapshot
+        cur.execute("BEGIN")
+        cur.execute("SELECT version FROM polls WHERE uuid = ?", (id,))
+        version_t = cur.fetchone()
+        if version_t is None:
+            poll_cache.delete(id)
+            return None
 
-        for choice_t in choice_ts:
-            choice = tuple_to_choice(choice_t)
+        return _get_cached_poll(cur, id, version_t[0])
 
-            for vote_t in vote_ts:
-                vote = tuple_to_vote(vote_t)
-                if vote.choice_id == choice.id:
-                    choice.votes.append(vote)
+@dataclass
+class PollNotificationInfo:
+    id: str
+    title: str
+    author_email: Optional[str]
+    manage_code: str
 
-            poll.choices.append(choice)
+def get_poll_notification_info(id: str) -> Optional[PollNotificationInfo]:
+    """Returns only the columns needed for notification emails, without assembling the whole poll."""
+    with db.cursor() as (conn, cur):
+        cur.execute("SELECT uuid, title, author_email, manage_code FROM polls WHERE uuid = ?", (id,))
+        poll_t = cur.fetchone()
+        if poll_t is None:
+            return None
 
-        return poll
+        return PollNotificationInfo(id=poll_t[0], title=poll_t[1], author_email=poll_t[2], manage_code=poll_t[3])
 
 def create_poll(title: str, description: Optional[str], author_name: str, author_email: Optional[str], is_whole_day: bool) -> Poll:
-    with db.cursor() as (conn, cur):
-        cur.execute("INSERT INTO polls (title, description, author_name, author_email, whole_day)"
-                    "VALUES (?, ?, ?, ?, ?)"
-                    "RETURNING *",
-                    (title, description, author_name, author_email, is_whole_day))
+    def create(cur: sqlite3.Cursor) -> Poll:
+        cur.execute("INSERT INTO polls (uuid, manage_code, title, description, author_name, author_email, whole_day, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP) "
+                    f"RETURNING {POLL_COLUMNS}",
+                    (str(uuid.uuid4()), str(uuid.uuid4()), title, description, author_name, author_email, is_whole_day))
         poll_t = cur.fetchone()
 
         if poll_t is None:
             raise Exception("Failed to create poll")
 
         return tuple_to_poll(poll_t)
+    return run_write(create)
+
+VOTE_POLL_NOT_FOUND = "poll_not_found"
+VOTE_INVALID_CHOICE = "invalid_choice"
+VOTE_NAME_IN_USE = "name_in_use"
+
+@dataclass
+class VoteResult:
+    manage_code: Optional[str] = None
+    error: Optional[str] = None  # one of the VOTE_ constants
+
+def vote_poll(poll_id: str, voter_name: str, selected_choice_ids: set[str]) -> VoteResult:
+    """Votes 1 on the selected choices and 0 on every other choice of the poll.
+
+    Returns the manage code of the vote, or an error if the poll does not exist,
+    a selected choice does not belong to the poll or the name is already in use.
+    """
+    def vote(cur: sqlite3.Cursor) -> VoteResult:
+        cur.execute("SELECT polls.id, polls.next_slot, choices.slot, choices.uuid, "
+                    "EXISTS (SELECT 1 FROM voters WHERE poll_id = polls.id AND name = ?) "
+                    "FROM polls LEFT JOIN choices ON choices.poll_id = polls.id "
+                    "WHERE polls.uuid = ?",
+                    (voter_name, poll_id))
+        rows = cur.fetchall()
+        if len(rows) == 0:
+            return VoteResult(error=VOTE_POLL_NOT_FOUND)
+        if rows[0][4]:
+            return VoteResult(error=VOTE_NAME_IN_USE)
+
+        poll_pk, next_slot = rows[0][0], rows[0][1]
+        slots_by_choice_id = {row[3]: row[2] for row in rows if row[3] is not None}
+        if not selected_choice_ids.issubset(slots_by_choice_id):
+            return VoteResult(error=VOTE_INVALID_CHOICE)
 
-def vote_poll(poll_id: str, voter_name: str, selections: dict[str, int]) -> Optional[str]:
-    """Returns the manage code of the vote or None if the vote failed on unique constraint."""
-    with db.cursor() as (conn, cur):
         manage_code = str(uuid.uuid4())
-        for choice_id, value in selections.items():
-            try:
-                cur.execute("INSERT INTO votes (poll_id, voter_name, choice_id, value, manage_code) VALUES (?, ?, ?, ?, ?)",
-                            (poll_id, voter_name, choice_id, value, manage_code))
-            except sqlite3.IntegrityError:
-                return None
-        return manage_code
+        # Voters are only shown through their votes, so voting on a poll
+        # without choices does not record the voter
+        if len(slots_by_choice_id) == 0:
+            return VoteResult(manage_code=manage_code)
+
+        bitmap = 0
+        for choice_id in selected_choice_ids:
+            bitmap |= 1 << slots_by_choice_id[choice_id]
+        try:
+            cur.execute("INSERT INTO voters (poll_id, name, manage_code, votes, slot_count) VALUES (?, ?, ?, ?, ?)",
+                        (poll_pk, voter_name, manage_code, bitmap_to_blob(bitmap, next_slot), next_slot))
+        except sqlite3.IntegrityError:
+            return VoteResult(error=VOTE_NAME_IN_USE)
+
+        _bump_poll_version(cur, poll_pk, POLL_CHANGE_VOTE, voter_name)
+        return VoteResult(manage_code=manage_code)
+    return run_write(vote)
 
 def get_poll_by_code(code: str) -> Optional[Poll]:
     with db.cursor() as (conn, cur):
-        cur.execute("SELECT id FROM polls WHERE manage_code = ?", (code,))
+        cur.execute("BEGIN")
+        cur.execute("SELECT uuid, version FROM polls WHERE manage_code = ?", (code,))
         poll_t = cur.fetchone()
         if poll_t is None:
             return None
 
-        return get_poll(poll_t[0])
+        return _get_cached_poll(cur, poll_t[0], poll_t[1])
 
 def update_poll_info(code: str, title: str, description: Optional[str], author_name: str, author_email: Optional[str], is_whole_day: bool) -> Optional[str]:
     """Returns the id of the updated poll or None if not found."""
-    with db.cursor() as (conn, cur):
+    def update(cur: sqlite3.Cursor) -> Optional[str]:
         cur.execute(
-            "UPDATE polls SET title = ?, description = ?, author_name = ?, author_email = ?, whole_day = ? WHERE manage_code = ?",
+            "UPDATE polls SET title = ?, description = ?, author_name = ?, author_email = ?, whole_day = ? "
+            "WHERE manage_code = ? RETURNING id, uuid",
             (title, description, author_name, author_email, is_whole_day, code)
         )
-        cur.execute("SELECT id FROM polls WHERE manage_code = ?", (code,))
         updated_poll = cur.fetchone()
-        return updated_poll[0] if updated_poll else None
+        if updated_poll is None:
+            return None
+
+        _bump_poll_version(cur, updated_poll[0], POLL_CHANGE_INFO)
+        return updated_poll[1]
+    return run_write(update)
 
 def add_choice_to_poll(code: str, start_datetime: str, end_datetime: str) -> None:
-    poll = get_poll_by_code(code)
-    if poll is None:
-        raise Exception(f"Poll not found for code: {code}")
+    def add(cur: sqlite3.Cursor) -> None:
+        cur.execute("UPDATE polls SET next_slot = next_slot + 1 WHERE manage_code = ? RETURNING id, next_slot - 1", (code,))
+        poll_t = cur.fetchone()
+        if poll_t is None:
+            raise Exception(f"Poll not found for code: {code}")
 
-    with db.cursor() as (conn, cur):
-        cur.execute("INSERT INTO choices (poll_id, start_datetime, end_datetime) VALUES (?, ?, ?)",
-                    (poll.id, start_datetime, end_datetime))
+        cur.execute("INSERT INTO choices (uuid, poll_id, slot, start_datetime, end_datetime) VALUES (?, ?, ?, ?, ?)",
+                    (str(uuid.uuid4()), poll_t[0], poll_t[1], start_datetime, end_datetime))
+        _bump_poll_version(cur, poll_t[0], POLL_CHANGE_CHOICES)
+    run_write(add)
+
+@dataclass
+class AddChoicesResult:
+    added: int
+    # Slots that were given more than once or that the poll has already
+    duplicates: int
+
+def add_choices_to_poll(code: str, slots: List[Tuple[str, str]]) -> Optional[AddChoicesResult]:
+    """Adds a choice for every (start_datetime, end_datetime) pair in one transaction.
+
+    Pairs equal to an existing choice of the poll or to an earlier pair are
+    skipped. Returns None if the poll does not exist.
+    """
+    def add(cur: sqlite3.Cursor) -> Optional[AddChoicesResult]:
+        cur.execute("SELECT id FROM polls WHERE manage_code = ?", (code,))
+        poll_t = cur.fetchone()
+        if poll_t is None:
+            return None
+        poll_pk = poll_t[0]
+
+        cur.execute("SELECT start_datetime, end_datetime FROM choices WHERE poll_id = ?", (poll_pk,))
+        seen = {(choice_t[0], choice_t[1]) for choice_t in cur.fetchall()}
+        new_slots = []
+        for slot in slots:
+            if slot not in seen:
+                seen.add(slot)
+                new_slots.append(slot)
+        if len(new_slots) == 0:
+            return AddChoicesResult(added=0, duplicates=len(slots))
+
+        cur.execute("UPDATE polls SET next_slot = next_slot + ? WHERE id = ? RETURNING next_slot - ?",
+                    (len(new_slots), poll_pk, len(new_slots)))
+        first_slot = cur.fetchone()[0]
+        cur.executemany("INSERT INTO choices (uuid, poll_id, slot, start_datetime, end_datetime) VALUES (?, ?, ?, ?, ?)",
+                        [(str(uuid.uuid4()), poll_pk, first_slot + i, start_datetime, end_datetime)
+                         for i, (start_datetime, end_datetime) in enumerate(new_slots)])
+        _bump_poll_version(cur, poll_pk, POLL_CHANGE_CHOICES)
+        return AddChoicesResult(added=len(new_slots), duplicates=len(slots) - len(new_slots))
+    return run_write(add)
 
 def delete_choice(choice_id: str) -> None:
-    with db.cursor() as (conn, cur):
-        cur.execute("DELETE FROM choices WHERE id = ?", (choice_id,))
-        cur.execute("DELETE FROM votes WHERE choice_id = ?", (choice_id,))
+    def delete(cur: sqlite3.Cursor) -> None:
+        # The slot of the choice is not reused, so its bits in the voters'
+        # bitmaps are simply ignored from now on
+        cur.execute("DELETE FROM choices WHERE uuid = ? RETURNING poll_id", (choice_id,))
+        choice_t = cur.fetchone()
+        if choice_t is not None:
+            # Voters are only shown through their votes
+            cur.execute("DELETE FROM voters WHERE poll_id = ? AND NOT EXISTS "
+                        "(SELECT 1 FROM choices WHERE poll_id = voters.poll_id AND slot < voters.slot_count)",
+                        (choice_t[0],))
+            _bump_poll_version(cur, choice_t[0], POLL_CHANGE_CHOICES)
+    run_write(delete)
+
+@dataclass
+class PollSummary:
+    id: str
+    title: str
+    manage_code: str
+    pub_date: datetime.datetime
+    choice_count: int
+    voter_count: int
+    first_start_datetime: Optional[datetime.datetime]
+    last_start_datetime: Optional[datetime.datetime]
+
+@dataclass
+class PollSummaryPage:
+    polls: List[PollSummary]
+    total: int
+    page: int
+    page_size: int
 
-def get_polls_by_codes(codes: List[str]) -> List[Poll]:
+    def page_count(self) -> int:
+        return max(1, -(-self.total // self.page_size))
+
+def get_poll_summaries_by_codes(codes: List[str], page: int, page_size: int) -> PollSummaryPage:
+    """Returns one page of the polls with the given manage codes, newest first, with their choice and voter counts.
+
+    The codes are passed as a single JSON array, so the statement is the same
+    for any number of codes and SQLite's parameter limit does not apply.
+    """
     with db.cursor() as (conn, cur):
-        query = "SELECT * FROM polls WHERE manage_code IN ({}) ORDER BY pub_date DESC".format(
-            ",".join("?" for _ in codes)
-        )
-        cur.execute(query, codes)
-        poll_ts = cur.fetchall()
-        return [tuple_to_poll(poll_t) for poll_t in poll_ts]
+        cur.execute("WITH page AS ("
+                    "  SELECT id, uuid, title, manage_code, pub_date, COUNT(*) OVER () AS total FROM polls"
+                    "  WHERE manage_code IN (SELECT value FROM json_each(?))"
+                    "  ORDER BY pub_date DESC, id LIMIT ? OFFSET ?"
+                    ") "
+                    "SELECT page.uuid, page.title, page.manage_code, page.pub_date, page.total,"
+                    "  (SELECT COUNT(*) FROM choices WHERE poll_id = page.id),"
+                    "  (SELECT COUNT(*) FROM voters WHERE poll_id = page.id),"
+                    "  (SELECT MIN(start_datetime) FROM choices WHERE poll_id = page.id),"
+                    "  (SELECT MAX(start_datetime) FROM choices WHERE poll_id = page.id) "
+                    "FROM page ORDER BY pub_date DESC, id",
+                    (json.dumps(codes), page_size, (page - 1) * page_size))
+        summary_ts = cur.fetchall()
+
+        if len(summary_ts) > 0:
+            total = summary_ts[0][4]
+        else:
+            # Past the last page the window function has no rows to count
+            cur.execute("SELECT COUNT(*) FROM polls WHERE manage_code IN (SELECT value FROM json_each(?))",
+                        (json.dumps(codes),))
+            total = cur.fetchone()[0]
+
+        with metrics.timed("mapper_seconds"):
+            polls = [
+                PollSummary(
+                    id=summary_t[0],
+                    title=summary_t[1],
+                    manage_code=summary_t[2],
+                    pub_date=parse_db_datetime(summary_t[3]),
+                    choice_count=summary_t[5],
+                    voter_count=summary_t[6],
+                    first_start_datetime=parse_db_datetime(summary_t[7]) if summary_t[7] else None,
+                    last_start_datetime=parse_db_datetime(summary_t[8]) if summary_t[8] else None,
+                )
+                for summary_t in summary_ts
+            ]
+        return PollSummaryPage(polls=polls, total=total, page=page, page_size=page_size)
 
 def delete_poll(code: str) -> None:
-    with db.cursor() as (conn, cur):
-        cur.execute("DELETE FROM polls WHERE manage_code = ?", (code,))
+    def delete(cur: sqlite3.Cursor) -> None:
+        cur.execute("DELETE FROM polls WHERE manage_code = ? RETURNING uuid, version", (code,))
+        for poll_t in cur.fetchall():
+            poll_cache.delete(poll_t[0])
+            open_transactions.stack[-1].append(PollChange(poll_t[0], poll_t[1] + 1, POLL_CHANGE_DELETED))
+    run_write(delete)
 
 def get_voter_name_by_manage_code(voter_manage_code: str) -> Optional[str]:
     with db.cursor() as (conn, cur):
-        cur.execute("SELECT voter_name FROM votes WHERE manage_code = ?", (voter_manage_code,))
+        cur.execute("SELECT name FROM voters WHERE manage_code = ?", (voter_manage_code,))
         voter_name = cur.fetchone()
         return voter_name[0] if voter_name else None
 
 def delete_voter(voter_manage_code: str) -> None:
+    def delete(cur: sqlite3.Cursor) -> None:
+        cur.execute("DELETE FROM voters WHERE manage_code = ? RETURNING poll_id, name", (voter_manage_code,))
+        for voter_t in cur.fetchall():
+            _bump_poll_version(cur, voter_t[0], POLL_CHANGE_VOTER_DELETED, voter_t[1])
+    run_write(delete)
+
+### Export
+
+@dataclass
+class ExportChoice:
+    id: str
+    slot: int
+    start_datetime: datetime.datetime
+    end_datetime: datetime.datetime
+
+@dataclass
+class ExportVoter:
+    name: str
+    bitmap: int
+    slot_count: int
+
+    def votes(self, choices: List[ExportChoice]) -> List[Optional[int]]:
+        """The votes on the choices in their order: 1, 0, or None for choices added after the voter voted."""
+        return [(self.bitmap >> choice.slot) & 1 if choice.slot < self.slot_count else None for choice in choices]
+
+@dataclass
+class PollExport:
+    id: str
+    title: str
+    description: Optional[str]
+    author_name: str
+    is_whole_day: bool
+    choices: List[ExportChoice]
+    # Read from the database while iterated, ordered by name
+    voters: Iterator[ExportVoter]
+
+@contextmanager
+def export_poll(code: str):
+    """Yields the poll with the manage code for exporting, or None if there is none.
+
+    Unlike get_poll_by_code it does not assemble the votes of all voters:
+    the voters are read one row at a time as `voters` is iterated, which has
+    to happen inside the block. Everything is read from one snapshot.
+    """
+    with db.cursor() as (conn, cur):
+        cur.execute("BEGIN")
+        cur.execute("SELECT id, uuid, title, description, author_name, whole_day FROM polls WHERE manage_code = ?", (code,))
+        poll_t = cur.fetchone()
+        if poll_t is None:
+            yield None
+            return
+
+        cur.execute("SELECT uuid, slot, start_datetime, end_datetime FROM choices WHERE poll_id = ? ORDER BY start_datetime",
+                    (poll_t[0],))
+        choices = [ExportChoice(id=choice_t[0], slot=choice_t[1], start_datetime=parse_db_datetime(choice_t[2]),
+                                end_datetime=parse_db_datetime(choice_t[3]))
+                   for choice_t in cur.fetchall()]
+
+        def voters() -> Iterator[ExportVoter]:
+            cur.execute("SELECT name, votes, slot_count FROM voters WHERE poll_id = ? ORDER BY name", (poll_t[0],))
+            for voter_t in cur:
+                yield ExportVoter(name=voter_t[0], bitmap=blob_to_bitmap(voter_t[1]), slot_count=voter_t[2])
+
+        yield PollExport(id=poll_t[1], title=poll_t[2], description=poll_t[3], author_name=poll_t[4],
+                         is_whole_day=bool(poll_t[5]), choices=choices, voters=voters())
+
+### Retention
+
+# A poll expires when its last choice has ended and it has not been changed
+# since the cutoff. Polls without choices expire by their last change.
+EXPIRED_POLL_CONDITION = ("polls.updated_at < :cutoff AND NOT EXISTS "
+                          "(SELECT 1 FROM choices WHERE choices.poll_id = polls.id AND choices.end_datetime >= :cutoff)")
+
+@dataclass
+class PurgeReport:
+    polls: int = 0
+    choices: int = 0
+    voters: int = 0
+    batches: int = 0
+
+def purge_expired_polls(cutoff: datetime.datetime, batch_size: int, archive: Optional[Callable[[Poll], None]] = None) -> PurgeReport:
+    """Deletes the polls that expired before cutoff, batch_size polls per transaction.
+
+    Candidates are looked up, and archived if archive is given, without the
+    write lock. They are checked again before they are deleted, and archived
+    polls that have changed since are left to the next run. Deleted polls are
+    published as POLL_CHANGE_DELETED once their batch has committed.
+    """
+    report = PurgeReport()
+    params = {"cutoff": cutoff.strftime(DB_DATE_FORMAT), "limit": batch_size, "after": 0}
+    while True:
+        with db.cursor() as (conn, cur):
+            # Archive the candidates as of the snapshot they were found in
+            cur.execute("BEGIN")
+            cur.execute(f"SELECT id, uuid, version FROM polls WHERE id > :after AND {EXPIRED_POLL_CONDITION} ORDER BY id LIMIT :limit",
+                        params)
+            candidate_ts = cur.fetchall()
+            if archive is not None:
+                for poll_t in candidate_ts:
+                    poll = _load_poll(cur, poll_t[1])
+                    if poll is not None:
+                        archive(poll)
+        if len(candidate_ts) == 0:
+            return report
+        params["after"] = candidate_ts[-1][0]
+        candidate_versions = {poll_t[0]: poll_t[2] for poll_t in candidate_ts}
+
+        with db.cursor() as (conn, cur):
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute(f"SELECT id, uuid, version FROM polls WHERE id IN (SELECT value FROM json_each(:pks)) AND {EXPIRED_POLL_CONDITION}",
+                        {**params, "pks": json.dumps(list(candidate_versions))})
+            expired_ts = [poll_t for poll_t in cur.fetchall()
+                          if archive is None or poll_t[2] == candidate_versions[poll_t[0]]]
+            pks = json.dumps([poll_t[0] for poll_t in expired_ts])
+
+            cur.execute("SELECT (SELECT count(*) FROM choices WHERE poll_id IN (SELECT value FROM json_each(:pks))), "
+                        "       (SELECT count(*) FROM voters WHERE poll_id IN (SELECT value FROM json_each(:pks)))",
+                        {"pks": pks})
+            choice_count, voter_count = cur.fetchone()
+            # Choices and voters are deleted by the foreign keys
+            cur.execute("DELETE FROM polls WHERE id IN (SELECT value FROM json_each(:pks))", {"pks": pks})
+            for poll_t in expired_ts:
+                poll_cache.delete(poll_t[1])
+                open_transactions.stack[-1].append(PollChange(poll_t[1], poll_t[2] + 1, POLL_CHANGE_DELETED))
+
+        report.polls += len(expired_ts)
+        report.choices += choice_count
+        report.voters += voter_count
+        report.batches += 1
+
+def database_size() -> int:
+    """Returns the size of the database file and its WAL in bytes."""
+    return sum(os.path.getsize(path) for path in (DB_PATH, DB_PATH + "-wal") if os.path.exists(path))
+
+def reclaim_space(pages_per_step: int = 1000) -> None:
+    """Returns free pages to the file system a few at a time and truncates the WAL.
+
+    Needs auto_vacuum = INCREMENTAL, set by migration 0008.
+    """
+    with db.cursor() as (conn, cur):
+        cur.execute("PRAGMA auto_vacuum")
+        if cur.fetchone()[0] == 2:
+            cur.execute("PRAGMA freelist_count")
+            free_pages = cur.fetchone()[0]
+            while free_pages > 0:
+                # Each step is a short write transaction of its own
+                cur.execute(f"PRAGMA incremental_vacuum({int(pages_per_step)})").fetchall()
+                cur.execute("PRAGMA freelist_count")
+                remaining_pages = cur.fetchone()[0]
+                if remaining_pages >= free_pages:
+                    break
+                free_pages = remaining_pages
+
+        cur.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+### Jobs
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    payload: dict
+    attempts: int
+
+def enqueue_job(kind: str, payload: dict, delay_seconds: int = 0) -> int:
+    def enqueue(cur: sqlite3.Cursor) -> int:
+        cur.execute("INSERT INTO jobs (kind, payload, run_after) VALUES (?, ?, datetime('now', ?)) RETURNING id",
+                    (kind, json.dumps(payload), f"+{delay_seconds} seconds"))
+        return cur.fetchone()[0]
+    return run_write(enqueue)
+
+def enqueue_coalesced_job(kind: str, coalesce_key: str, list_field: str, value, payload: dict, delay_seconds: int = 0) -> int:
+    """Appends value to payload[list_field] of the pending job with the same coalesce key.
+
+    If there is no such job, a new one is enqueued with payload[list_field] = [value].
+    """
+    def enqueue(cur: sqlite3.Cursor) -> int:
+        cur.execute("UPDATE jobs SET payload = json_insert(payload, '$.' || ? || '[#]', ?) "
+                    "WHERE coalesce_key = ? AND kind = ? AND status = 'pending' "
+                    "RETURNING id",
+                    (list_field, value, coalesce_key, kind))
+        job_t = cur.fetchone()
+        if job_t is not None:
+            return job_t[0]
+
+        cur.execute("INSERT INTO jobs (kind, payload, coalesce_key, run_after) VALUES (?, ?, ?, datetime('now', ?)) RETURNING id",
+                    (kind, json.dumps({**payload, list_field: [value]}), coalesce_key, f"+{delay_seconds} seconds"))
+        return cur.fetchone()[0]
+    return run_write(enqueue)
+
+def claim_job(lease_seconds: int) -> Optional[Job]:
+    """Atomically marks the next due job as running and returns it, or None if no job is due.
+
+    Jobs whose lease has expired (e.g. because their worker died) are claimed again.
+    """
+    due_condition = ("(status = 'pending' AND run_after <= CURRENT_TIMESTAMP) OR "
+                     "(status = 'running' AND locked_until <= CURRENT_TIMESTAMP)")
+    with db.cursor() as (conn, cur):
+        # Look for work without taking the write lock, idle workers poll this.
+        # Each branch is a single lookup in idx_jobs_status_run_after, where
+        # the OR of both sorted every due job to find the first one.
+        cur.execute("SELECT id FROM ("
+                    "  SELECT * FROM (SELECT id, run_after FROM jobs WHERE status = 'pending' AND run_after <= CURRENT_TIMESTAMP "
+                    "                 ORDER BY run_after, id LIMIT 1) "
+                    "  UNION ALL "
+                    "  SELECT * FROM (SELECT id, run_after FROM jobs WHERE status = 'running' AND locked_until <= CURRENT_TIMESTAMP "
+                    "                 ORDER BY run_after, id LIMIT 1)"
+                    ") ORDER BY run_after, id LIMIT 1")
+        job_t = cur.fetchone()
+        if job_t is None:
+            return None
+
+        cur.execute(f"UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = datetime('now', ?) "
+                    f"WHERE id = ? AND ({due_condition}) "
+                    "RETURNING id, kind, payload, attempts",
+                    (f"+{lease_seconds} seconds", job_t[0]))
+        job_t = cur.fetchone()
+        if job_t is None:
+            # Another worker claimed it first
+            return None
+
+        return Job(id=job_t[0], kind=job_t[1], payload=json.loads(job_t[2]), attempts=job_t[3])
+
+def complete_job(id: int) -> None:
+    with db.cursor() as (conn, cur):
+        cur.execute("DELETE FROM jobs WHERE id = ?", (id,))
+
+def retry_job(id: int, error: str, delay_seconds: int) -> None:
+    with db.cursor() as (conn, cur):
+        cur.execute("UPDATE jobs SET status = 'pending', locked_until = NULL, last_error = ?, run_after = datetime('now', ?) WHERE id = ?",
+                    (error, f"+{delay_seconds} seconds", id))
+
+def purge_failed_jobs(cutoff: datetime.datetime) -> int:
+    """Deletes the failed jobs created before cutoff, which are kept for inspection until then. Returns their number."""
+    with db.cursor() as (conn, cur):
+        cur.execute("DELETE FROM jobs WHERE status = 'failed' AND created_at < ?", (cutoff.strftime(DB_DATE_FORMAT),))
+        return cur.rowcount
+
+def fail_job(id: int, error: str) -> None:
     with db.cursor() as (conn, cur):
-        cur.execute("DELETE FROM votes WHERE manage_code = ?", (voter_manage_code,))
+        cur.execute("UPDATE jobs SET status = 'failed', locked_until = NULL, last_error = ? WHERE id = ?",
+                    (error, id))
 
 ### Migrations
 
@@ -264,6 +1040,26 @@ def ensure_migration_applied(number: int, migration_sql: str) -> bool:
         if cur.fetchone() is not None:
             return False
 
-        cur.execute("INSERT INTO applied_migrations (number) VALUES (?)", (number,))
+        # executescript commits before it runs, so the migration is only
+        # recorded once it has succeeded
         cur.executescript(migration_sql)
+        cur.execute("INSERT INTO applied_migrations (number) VALUES (?)", (number,))
+        return True
+
+def foreign_key_violations() -> List[Tuple]:
+    """Returns (table, rowid, referenced table, foreign key index) of every row whose foreign key points nowhere."""
+    with db.cursor() as (conn, cur):
+        cur.execute("PRAGMA foreign_key_check")
+        return [tuple(row) for row in cur.fetchall()]
+
+def ensure_python_migration_applied(number: int, migrate: Callable[[sqlite3.Cursor], None]) -> bool:
+    """Like ensure_migration_applied, for migrations that need Python. migrate runs in the same transaction as the bookkeeping."""
+    with db.cursor() as (conn, cur):
+        cur.execute("SELECT 1 FROM applied_migrations WHERE number = ?", (number,))
+        if cur.fetchone() is not None:
+            return False
+
+        cur.execute("BEGIN IMMEDIATE")
+        migrate(cur)
+        cur.execute("INSERT INTO applied_migrations (number) VALUES (?)", (number,))
         return True
@@ -1,17 +1,119 @@
 import os
 import sys
-import traceback
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import threading
+import time
+from typing import TYPE_CHECKING, Callable
 
 import db
 
+# smtplib and the MIME modules are imported on first use, see import_smtp_dependencies
+if TYPE_CHECKING:
+  import smtplib
+  from email.message import Message
+
 BASE_URL = os.environ["BASE_URL"]
+# One session per job worker thread by default, see jobs.JOB_WORKERS
+EMAIL_POOL_SIZE = int(os.environ.get("EMAIL_POOL_SIZE", os.environ.get("JOB_WORKERS", "4")))
+EMAIL_IDLE_TIMEOUT = float(os.environ.get("EMAIL_IDLE_TIMEOUT", "60"))
+EMAIL_DIGEST_WINDOW = int(os.environ.get("EMAIL_DIGEST_WINDOW", "0"))
 
-def send_email(subject: str, body: str, recipient: str):
+Email = tuple[str, str, str] # subject, body, recipient
+
+def send_emails(emails: list[Email]):
   pass
 
+def send_email(subject: str, body: str, recipient: str):
+  send_emails([(subject, body, recipient)])
+
+def import_smtp_dependencies():
+  import smtplib
+  import email.mime.multipart
+  import email.mime.text
+
+class SmtpSession:
+  def __init__(self, server: "smtplib.SMTP"):
+    self.server = server
+    self.last_used = time.monotonic()
+    self.messages_sent = 0
+
+class SmtpPool:
+  """Keeps up to `size` authenticated SMTP sessions open for reuse.
+
+  Sessions that have been idle for longer than `idle_timeout` seconds are
+  closed instead of reused, since servers tend to drop idle clients.
+  """
+
+  def __init__(self, connect: Callable[[], "smtplib.SMTP"], size: int, idle_timeout: float):
+    self.connect = connect
+    self.size = size
+    self.idle_timeout = idle_timeout
+    self.lock = threading.Lock()
+    self.idle: list[SmtpSession] = []
+    self.connections_opened = 0
+    self.messages_sent = 0
+
+  def send(self, messages: list["Message"]):
+    """Sends all messages over one session, reconnecting once if the server has hung up."""
+    import smtplib
+    session = self._acquire()
+    try:
+      for message in messages:
+        try:
+          session.server.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+          self._close(session)
+          session = self._open()
+          session.server.send_message(message)
+
+        session.messages_sent += 1
+        with self.lock:
+          self.messages_sent += 1
+    except Exception:
+      self._close(session)
+      raise
+
+    self._release(session)
+
+  def stats(self) -> dict[str, float]:
+    with self.lock:
+      return {
+        "connections_opened": self.connections_opened,
+        "messages_sent": self.messages_sent,
+        "idle": len(self.idle),
+      }
+
+  def _open(self) -> SmtpSession:
+    session = SmtpSession(self.connect())
+    with self.lock:
+      self.connections_opened += 1
+    return session
+
+  def _acquire(self) -> SmtpSession:
+    while True:
+      with self.lock:
+        session = self.idle.pop() if self.idle else None
+
+      if session is None:
+        return self._open()
+      if time.monotonic() - session.last_used <= self.idle_timeout:
+        return session
+      self._close(session)
+
+  def _release(self, session: SmtpSession):
+    session.last_used = time.monotonic()
+    with self.lock:
+      if len(self.idle) < self.size:
+        self.idle.append(session)
+        return
+    self._close(session)
+
+  def _close(self, session: SmtpSession):
+    import smtplib
+    try:
+      session.server.quit()
+    except (smtplib.SMTPException, OSError):
+      session.server.close()
+
 email_env_vars = [
   "EMAIL_HOST",
   "EMAIL_PORT",
@@ -43,9 +145,24 @@ if email_enabled:
 
   print(f"SMTP email client enabled using email host {email_host}")
 
-  def _actual_send_email(subject: str, body: str, recipient: str):
-    if not email_enabled:
-      return
+  def _connect() -> "smtplib.SMTP":
+    import smtplib
+    server = smtplib.SMTP(email_host, email_port)
+    try:
+      if email_use_tls:
+        server.starttls()
+
+      server.login(email_host_user, email_host_password)
+    except Exception:
+      server.close()
+      raise
+    return server
+
+  smtp_pool = SmtpPool(_connect, size=EMAIL_POOL_SIZE, idle_timeout=EMAIL_IDLE_TIMEOUT)
+
+  def _build_message(subject: str, body: str, recipient: str) -> "Message":
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
 
     msg = MIMEMultipart()
     msg['From'] = email_message_from
@@ -55,39 +172,46 @@ if email_enabled:
     msg.add_header("Content-Type", "text/plain; charset=utf-8")
     for key, value in email_headers.items():
       msg.add_header(key, value)
+    return msg
 
-    with smtplib.SMTP(email_host, email_port) as server:
-      if email_use_tls:
-        server.starttls()
-
-      server.login(email_host_user, email_host_password)
-      server.send_message(msg)
+  def _actual_send_emails(emails: list[Email]):
+    smtp_pool.send([_build_message(*email) for email in emails])
 
-  send_email = _actual_send_email
+  send_emails = _actual_send_emails
 else:
   print("SMTP email client not enabled")
 
-def send_participation_email(poll_id: str, voter_name: str):
-  poll = db.get_poll(poll_id)
+def send_participation_email(poll_id: str, voter_names: list[str]):
+  """Sends one email about all voter_names, i.e. a digest if several people participated."""
+  poll = db.get_poll_notification_info(poll_id)
   if not poll or poll.author_email is None or poll.author_email.strip() == "":
     return
 
+  if len(voter_names) == 1:
+    subject = f"{voter_names[0]} participated in your poll \"{poll.title}\""
+    summary = f"{voter_names[0]} participated in your diddle \"{poll.title}\".\n\n"
+  else:
+    subject = f"{len(voter_names)} people participated in your poll \"{poll.title}\""
+    summary = (f"The following people participated in your diddle \"{poll.title}\":\n\n"
+               + "".join(f"- {voter_name}\n" for voter_name in voter_names)
+               + "\n")
+
   print(f"Sending participation email to {poll.author_email}")
   try:
     send_email(
-      subject=f"{voter_name} participated in your poll \"{poll.title}\"",
-      body=f"{voter_name} participated in your diddle \"{poll.title}\".\n\n"
+      subject=subject,
+      body=summary +
             f"View the results at {BASE_URL}/poll/{poll.id}\n"
             f"Manage your diddle at {BASE_URL}/manage/{poll.manage_code}\n"
             "You will be notified by email when someone participates.",
       recipient=poll.author_email,
     )
-  except Exception as e:
-    traceback.print_exc(file=sys.stderr)
+  except Exception:
     print(f"Failed to send participation email to {poll.author_email}", file=sys.stderr)
+    raise
 
 def send_poll_created_email(poll_id: str):
-  poll = db.get_poll(poll_id)
+  poll = db.get_poll_notification_info(poll_id)
   if not poll or poll.author_email is None or poll.author_email.strip() == "":
     return
 
@@ -99,6 +223,6 @@ def send_poll_created_email(poll_id: str):
             "You will be notified by email when someone participates.",
       recipient=poll.author_email,
     )
-  except Exception as e:
-    traceback.print_exc(file=sys.stderr)
+  except Exception:
     print(f"Failed to send poll created email to {poll.author_email}", file=sys.stderr)
+    raise
@@ -0,0 +1,162 @@
+"""Poll exports generated row by row from db.export_poll.
+
+Every export is a generator of byte chunks for a streamed response, so a
+poll is exported in constant memory whatever its number of voters. The
+first chunk is sent before any voter is read.
+"""
+import csv
+import datetime
+import io
+import json
+import urllib.parse
+from typing import Iterable, Iterator, List, Optional
+
+import db
+
+EXPORT_CHUNK_SIZE = 16 * 1024
+
+def chunked(pieces: Iterable[str], size: int = EXPORT_CHUNK_SIZE) -> Iterator[bytes]:
+    """Joins the pieces into chunks of about `size` bytes, rather than sending a row per write."""
+    buffer: List[str] = []
+    length = 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(buffer).encode()
+            buffer = []
+            length = 0
+    if len(buffer) > 0:
+        yield "".join(buffer).encode()
+
+def choice_interval(poll: db.PollExport, choice: db.ExportChoice) -> str:
+    """The choice as an ISO 8601 interval, e.g. 2030-01-01T10:00/2030-01-01T11:00."""
+    if poll.is_whole_day:
+        return f"{choice.start_datetime.date().isoformat()}/{choice.end_datetime.date().isoformat()}"
+    return f"{choice.start_datetime.isoformat(timespec='minutes')}/{choice.end_datetime.isoformat(timespec='minutes')}"
+
+### CSV
+
+def csv_cell(value: str) -> str:
+    # Spreadsheets run cells starting with these as formulas
+    if value.startswith(("=", "+", "-", "@", "\t", "\r")):
+        return "'" + value
+    return value
+
+def csv_export(poll: db.PollExport) -> Iterator[bytes]:
+    """One row per voter with 1 or 0 per choice, empty for choices added after they voted, and a row of totals."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def row(values: List) -> str:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()
+
+    yield row(["Voter", *(choice_interval(poll, choice) for choice in poll.choices)]).encode()
+
+    yes_counts = [0] * len(poll.choices)
+    def voter_rows() -> Iterator[str]:
+        for voter in poll.voters:
+            votes = voter.votes(poll.choices)
+            for i, vote in enumerate(votes):
+                if vote == 1:
+                    yes_counts[i] += 1
+            yield row([csv_cell(voter.name), *("" if vote is None else vote for vote in votes)])
+        yield row(["Yes votes", *yes_counts])
+
+    yield from chunked(voter_rows())
+
+### JSON
+
+def json_export(poll: db.PollExport) -> Iterator[bytes]:
+    """The poll with its choices, every voter's votes in the order of the choices, and the yes votes per choice."""
+    head = json.dumps({
+        "id": poll.id,
+        "title": poll.title,
+        "description": poll.description,
+        "author_name": poll.author_name,
+        "whole_day": poll.is_whole_day,
+        "choices": [{"id": choice.id,
+                     "start_datetime": choice.start_datetime.isoformat(),
+                     "end_datetime": choice.end_datetime.isoformat()}
+                    for choice in poll.choices],
+    })
+    yield (head[:-1] + ', "voters": [').encode()
+
+    yes_counts = [0] * len(poll.choices)
+    def voter_objects() -> Iterator[str]:
+        separator = ""
+        for voter in poll.voters:
+            votes = voter.votes(poll.choices)
+            for i, vote in enumerate(votes):
+                if vote == 1:
+                    yes_counts[i] += 1
+            yield separator + json.dumps({"name": voter.name, "votes": votes})
+            separator = ", "
+        yield '], "yes_counts": ' + json.dumps(yes_counts) + "}"
+
+    yield from chunked(voter_objects())
+
+### iCalendar
+
+def ics_text(value: str) -> str:
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\r\n", "\\n").replace("\n", "\\n")
+
+def ics_line(line: str) -> str:
+    """Folds the line after at most 75 octets, as RFC 5545 requires."""
+    folded = []
+    current = ""
+    current_size = 0
+    for char in line:
+        char_size = len(char.encode())
+        if current_size + char_size > 75:
+            folded.append(current)
+            current, current_size = " ", 1
+        current += char
+        current_size += char_size
+    folded.append(current)
+    return "\r\n".join(folded) + "\r\n"
+
+def ics_export(poll: db.PollExport, now: Optional[datetime.datetime] = None) -> Iterator[bytes]:
+    """The choices with the most yes votes as events. Times are floating, like the times of the poll."""
+    yield (ics_line("BEGIN:VCALENDAR") + ics_line("VERSION:2.0") + ics_line("PRODID:-//diddle//poll export//EN")).encode()
+
+    yes_counts = db.count_bits_by_slot((voter.bitmap for voter in poll.voters), [choice.slot for choice in poll.choices])
+    most_yes_votes = max(yes_counts.values(), default=0)
+    winners = [choice for choice in poll.choices if most_yes_votes > 0 and yes_counts[choice.slot] == most_yes_votes]
+
+    share_url = f"{db.BASE_URL}/poll/{poll.id}"
+    host = urllib.parse.urlparse(share_url).hostname or "diddle"
+    stamp = (now or datetime.datetime.now(datetime.timezone.utc)).strftime("%Y%m%dT%H%M%SZ")
+    description = f"{most_yes_votes} yes votes in {share_url}"
+    if poll.description:
+        description = poll.description + "\n\n" + description
+
+    def events() -> Iterator[str]:
+        for choice in winners:
+            yield ics_line("BEGIN:VEVENT")
+            yield ics_line(f"UID:{choice.id}@{host}")
+            yield ics_line(f"DTSTAMP:{stamp}")
+            if poll.is_whole_day:
+                # The end date of an all-day event is exclusive
+                end_date = choice.end_datetime.date() + datetime.timedelta(days=1)
+                yield ics_line(f"DTSTART;VALUE=DATE:{choice.start_datetime.strftime('%Y%m%d')}")
+                yield ics_line(f"DTEND;VALUE=DATE:{end_date.strftime('%Y%m%d')}")
+            else:
+                yield ics_line(f"DTSTART:{choice.start_datetime.strftime('%Y%m%dT%H%M%S')}")
+                yield ics_line(f"DTEND:{choice.end_datetime.strftime('%Y%m%dT%H%M%S')}")
+            yield ics_line(f"SUMMARY:{ics_text(poll.title)}")
+            yield ics_line(f"DESCRIPTION:{ics_text(description)}")
+            yield ics_line(f"URL:{share_url}")
+            yield ics_line("END:VEVENT")
+        yield ics_line("END:VCALENDAR")
+
+    yield from chunked(events())
+
+FORMATS = {
+    "csv": ("text/csv", csv_export),
+    "json": ("application/json", json_export),
+    "ics": ("text/calendar", ics_export),
+}
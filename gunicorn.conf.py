@@ -0,0 +1,46 @@
+# gunicorn settings, used by scripts/container_entrypoint.sh
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("GUNICORN_WORKERS", "4"))
+# Threaded workers, as every open live update stream of a poll page holds a
+# thread. SSE_MAX_STREAMS keeps some of them free for other requests.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+# Import the app once in the master and fork the workers from it, so that they
+# share the imported code and boot faster
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() in ["true", "1", "yes"]
+
+def on_starting(server):
+    import metrics
+    if metrics.METRICS_ENABLED:
+        metrics.reset()
+
+def when_ready(server):
+    if preload_app:
+        import app
+        app.import_lazy_dependencies()
+
+def post_fork(server, worker):
+    # Threads do not survive fork, so the job worker is started in each worker process
+    import jobs
+    jobs.start_worker()
+
+def post_worker_init(worker):
+    # Open event streams would hold up a graceful shutdown of the worker until
+    # graceful_timeout, so end them as soon as it is asked to stop
+    import signal
+    import notify
+    def handle_exit(sig, frame):
+        notify.close_streams()
+        worker.handle_exit(sig, frame)
+    signal.signal(signal.SIGTERM, handle_exit)
+
+def worker_exit(server, worker):
+    import notify
+    notify.stop_listener()
+
+def child_exit(server, worker):
+    import metrics
+    if metrics.METRICS_ENABLED:
+        metrics.retire(worker.pid)
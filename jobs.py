@@ -0,0 +1,104 @@
+import os
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import db
+import email_client
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_DELAY = int(os.environ.get("JOB_RETRY_DELAY", "30"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+JOB_LEASE_SECONDS = 300
+
+Handler = Callable[[dict], None]
+handlers: dict[str, Handler] = {}
+
+# Wakes up the worker of this process right away when a job is enqueued here.
+# Workers in other processes pick the job up on their next poll.
+wakeup = threading.Event()
+worker_pid: Optional[int] = None
+
+def handler(kind: str) -> Callable[[Handler], Handler]:
+    def register(fn: Handler) -> Handler:
+        handlers[kind] = fn
+        return fn
+    return register
+
+def enqueue(kind: str, delay_seconds: int = 0, **payload) -> None:
+    if kind not in handlers:
+        raise Exception(f"Unknown job kind: {kind}")
+
+    db.enqueue_job(kind, payload, delay_seconds=delay_seconds)
+    wakeup.set()
+
+def enqueue_coalesced(kind: str, coalesce_key: str, list_field: str, value, delay_seconds: int = 0, **payload) -> None:
+    """Adds value to the pending job with the same coalesce_key, or enqueues a new job for it.
+
+    The job runs once after delay_seconds with payload[list_field] listing
+    every value added in the meantime.
+    """
+    if kind not in handlers:
+        raise Exception(f"Unknown job kind: {kind}")
+
+    db.enqueue_coalesced_job(kind, coalesce_key, list_field, value, payload, delay_seconds=delay_seconds)
+    wakeup.set()
+
+def run_job(job: db.Job) -> None:
+    try:
+        handlers[job.kind](job.payload)
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        error = f"{type(e).__name__}: {e}"
+        if job.attempts >= JOB_MAX_ATTEMPTS:
+            print(f"Job {job.id} ({job.kind}) failed after {job.attempts} attempts", file=sys.stderr)
+            db.fail_job(job.id, error)
+        else:
+            delay = JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            print(f"Job {job.id} ({job.kind}) failed, retrying in {delay}s", file=sys.stderr)
+            db.retry_job(job.id, error, delay_seconds=delay)
+    else:
+        db.complete_job(job.id)
+
+def worker_loop() -> None:
+    print(f"Job worker started with {JOB_WORKERS} threads")
+    slots = threading.Semaphore(JOB_WORKERS)
+    with ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job") as executor:
+        while True:
+            slots.acquire()
+            try:
+                job = db.claim_job(lease_seconds=JOB_LEASE_SECONDS)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                job = None
+
+            if job is None:
+                slots.release()
+                wakeup.wait(JOB_POLL_INTERVAL)
+                wakeup.clear()
+                continue
+
+            future = executor.submit(run_job, job)
+            future.add_done_callback(lambda _: slots.release())
+
+def start_worker() -> None:
+    """Starts the job worker thread of this process unless it is already running."""
+    global worker_pid
+    if worker_pid == os.getpid():
+        return
+
+    worker_pid = os.getpid()
+    threading.Thread(target=worker_loop, daemon=True).start()
+
+### Handlers
+
+@handler("poll_created_email")
+def poll_created_email(payload: dict) -> None:
+    email_client.send_poll_created_email(poll_id=payload["poll_id"])
+
+@handler("participation_email")
+def participation_email(payload: dict) -> None:
+    email_client.send_participation_email(poll_id=payload["poll_id"], voter_names=payload["voter_names"])
@@ -0,0 +1,371 @@
+"""Opt-in request instrumentation, enabled with METRICS_ENABLED.
+
+Every request gets a Server-Timing header with its wall time, SQL statement
+count, connections opened, and time spent in the row mappers, in template
+rendering and in compression. The same numbers are aggregated per process
+and written to METRICS_DIR, from where /metrics serves the sum over all
+worker processes in the Prometheus text format. With PROFILE_SLOW_REQUEST_MS
+set, requests slower than that are sampled and their stacks written to
+PROFILE_DIR in the collapsed format of flamegraph.pl and speedscope.
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterable, Optional, Tuple
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() in ["true", "1", "yes"]
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "diddle_metrics"))
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "1"))
+PROFILE_SLOW_REQUEST_MS = float(os.environ.get("PROFILE_SLOW_REQUEST_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(METRICS_DIR, "profiles"))
+
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+### Per-request timings
+
+@dataclass
+class RequestTimings:
+    sql_statements: int = 0
+    connections_opened: int = 0
+    mapper_seconds: float = 0.0
+    render_seconds: float = 0.0
+    compression_seconds: float = 0.0
+
+# Timings of the request handled by the current thread, None outside of
+# requests and when metrics are disabled
+local = threading.local()
+
+def current() -> Optional[RequestTimings]:
+    return getattr(local, "timings", None)
+
+def count_sql_statement(statement: str) -> None:
+    """sqlite3 trace callback, see db.Db.connect."""
+    timings = current()
+    if timings is not None:
+        timings.sql_statements += 1
+
+def count_connection_opened() -> None:
+    timings = current()
+    if timings is not None:
+        timings.connections_opened += 1
+
+def add_time(field: str, seconds: float) -> None:
+    timings = current()
+    if timings is not None:
+        setattr(timings, field, getattr(timings, field) + seconds)
+
+@contextmanager
+def timed(field: str):
+    """Adds the time spent in the block to a RequestTimings field of the current request."""
+    if current() is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(field, time.perf_counter() - start)
+
+### Process totals
+
+Labels = Tuple[Tuple[str, str], ...]
+
+lock = threading.Lock()
+counters: dict[Tuple[str, Labels], float] = {}
+# Per-bucket counts followed by the sum and the count of the observations
+histograms: dict[Tuple[str, Labels], list[float]] = {}
+# Upper bounds of the buckets of every histogram
+histogram_buckets: dict[str, list[float]] = {}
+# Name to (type, help) of every metric
+descriptions: dict[str, Tuple[str, str]] = {}
+# Functions returning (name, labels, value) of gauges and counters kept elsewhere, e.g. cache stats
+collectors: list[Callable[[], Iterable[Tuple[str, dict, float]]]] = []
+last_flush = 0.0
+
+def describe(name: str, kind: str, help: str) -> None:
+    descriptions[name] = (kind, help)
+
+def register_collector(collector: Callable[[], Iterable[Tuple[str, dict, float]]]) -> Callable:
+    collectors.append(collector)
+    return collector
+
+def inc(name: str, value: float = 1.0, **labels: str) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        counters[key] = counters.get(key, 0.0) + value
+
+def observe(name: str, value: float, buckets: list[float] = DURATION_BUCKETS, **labels: str) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0.0] * (len(buckets) + 2)
+            histogram_buckets[name] = buckets
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+def snapshot() -> dict:
+    with lock:
+        values = [[name, dict(labels), value] for (name, labels), value in counters.items()]
+        histogram_values = [[name, dict(labels), histogram] for (name, labels), histogram in histograms.items()]
+        buckets = dict(histogram_buckets)
+    for collector in collectors:
+        values.extend([name, labels, value] for name, labels, value in collector())
+    gauges = [name for name, (kind, _) in descriptions.items() if kind == "gauge"]
+    return {"values": values, "histograms": histogram_values, "buckets": buckets, "gauges": gauges}
+
+def write_snapshot(path: str, data: dict) -> None:
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+def flush(force: bool = False) -> None:
+    """Writes the totals of this process to METRICS_DIR, at most every METRICS_FLUSH_INTERVAL seconds."""
+    global last_flush
+    now = time.monotonic()
+    if not force and now - last_flush < METRICS_FLUSH_INTERVAL:
+        return
+    last_flush = now
+
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    write_snapshot(os.path.join(METRICS_DIR, f"{os.getpid()}.json"), snapshot())
+
+def reset() -> None:
+    """Removes the totals of earlier runs, called when the gunicorn master starts."""
+    if os.path.isdir(METRICS_DIR):
+        for name in os.listdir(METRICS_DIR):
+            if name.endswith(".json"):
+                os.remove(os.path.join(METRICS_DIR, name))
+
+def retire(pid: int) -> None:
+    """Folds the totals of an exited worker process into exited.json, called by the gunicorn master.
+
+    Its counters and histograms keep counting in the sums, so they do not go
+    down when workers are restarted. Its gauges, e.g. cache weights, are
+    dropped, as they describe a process that is gone.
+    """
+    path = os.path.join(METRICS_DIR, f"{pid}.json")
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    exited_path = os.path.join(METRICS_DIR, "exited.json")
+    values: dict[Tuple[str, Labels], float] = {}
+    histogram_values: dict[Tuple[str, Labels], list[float]] = {}
+    buckets_by_metric: dict[str, list[float]] = {}
+    try:
+        with open(exited_path) as f:
+            add_totals(json.load(f), values, histogram_values, buckets_by_metric)
+    except (OSError, ValueError):
+        pass
+    add_totals(data, values, histogram_values, buckets_by_metric, skip=set(data.get("gauges", [])))
+
+    write_snapshot(exited_path, {
+        "values": [[name, dict(labels), value] for (name, labels), value in values.items()],
+        "histograms": [[name, dict(labels), histogram] for (name, labels), histogram in histogram_values.items()],
+        "buckets": buckets_by_metric,
+    })
+    os.remove(path)
+
+def add_totals(data: dict, values: dict[Tuple[str, Labels], float], histogram_values: dict[Tuple[str, Labels], list[float]],
+               buckets_by_metric: dict[str, list[float]], skip: set[str] = set()) -> None:
+    """Adds the totals of a snapshot to the given sums."""
+    for metric, labels, value in data["values"]:
+        if metric in skip:
+            continue
+        key = (metric, tuple(sorted(labels.items())))
+        values[key] = values.get(key, 0.0) + value
+    for metric, labels, histogram in data["histograms"]:
+        key = (metric, tuple(sorted(labels.items())))
+        total = histogram_values.setdefault(key, [0.0] * len(histogram))
+        for i, count in enumerate(histogram):
+            total[i] += count
+    buckets_by_metric.update(data.get("buckets", {}))
+
+def format_labels(labels: dict, **extra: str) -> str:
+    items = {**labels, **extra}
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(items.items())) + "}"
+
+def render_prometheus() -> str:
+    """Sums the totals of all worker processes, including exited ones, into the Prometheus text format."""
+    flush(force=True)
+    values: dict[Tuple[str, Labels], float] = {}
+    histogram_values: dict[Tuple[str, Labels], list[float]] = {}
+    buckets_by_metric: dict[str, list[float]] = {}
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        add_totals(data, values, histogram_values, buckets_by_metric)
+
+    lines: list[str] = []
+    described: set[str] = set()
+    def header(metric: str):
+        if metric not in described and metric in descriptions:
+            kind, help = descriptions[metric]
+            lines.append(f"# HELP {metric} {help}")
+            lines.append(f"# TYPE {metric} {kind}")
+            described.add(metric)
+
+    for (metric, labels), value in sorted(values.items()):
+        header(metric)
+        lines.append(f"{metric}{format_labels(dict(labels))} {value:g}")
+    for (metric, labels), histogram in sorted(histogram_values.items()):
+        header(metric)
+        buckets = histogram[:-2]
+        for bound, count in zip(buckets_by_metric.get(metric, DURATION_BUCKETS), buckets):
+            lines.append(f"{metric}_bucket{format_labels(dict(labels), le=f'{bound:g}')} {count:g}")
+        lines.append(f"{metric}_bucket{format_labels(dict(labels), le='+Inf')} {histogram[-1]:g}")
+        lines.append(f"{metric}_sum{format_labels(dict(labels))} {histogram[-2]:g}")
+        lines.append(f"{metric}_count{format_labels(dict(labels))} {histogram[-1]:g}")
+    return "\n".join(lines) + "\n"
+
+### Sampling profiler
+
+def collapse_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_code.co_qualname} ({os.path.basename(frame.f_code.co_filename)})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class SamplingProfiler:
+    """Samples the stacks of the threads that are handling requests every `interval` seconds."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.samples: dict[int, Counter[str]] = {}
+        self.pid: Optional[int] = None
+
+    def start(self, thread_id: int) -> None:
+        with self.lock:
+            # Threads do not survive fork, start the sampler in every worker process
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, daemon=True).start()
+            self.samples[thread_id] = Counter()
+
+    def stop(self, thread_id: int) -> Counter[str]:
+        with self.lock:
+            return self.samples.pop(thread_id, Counter())
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, stacks in self.samples.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[collapse_stack(frame)] += 1
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+
+def write_profile(endpoint: str, duration: float, stacks: Counter[str]) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%dT%H%M%S')}_{os.getpid()}_{endpoint}_{duration * 1000:.0f}ms.folded")
+    with open(path, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+### Flask integration
+
+describe("diddle_http_requests_total", "counter", "Requests by endpoint, method and status")
+describe("diddle_http_request_duration_seconds", "histogram", "Request wall time by endpoint")
+describe("diddle_sql_statements_total", "counter", "SQL statements executed by requests")
+describe("diddle_db_connections_opened_total", "counter", "SQLite connections opened by requests")
+describe("diddle_mapper_seconds_total", "counter", "Time requests spent mapping rows to objects")
+describe("diddle_template_render_seconds_total", "counter", "Time requests spent rendering templates")
+describe("diddle_compression_seconds_total", "counter", "Time requests spent compressing responses")
+
+def server_timing(timings: RequestTimings, duration: float) -> str:
+    return ", ".join([
+        f"total;dur={duration * 1000:.2f}",
+        f'sql;desc="{timings.sql_statements} statements"',
+        f'db;desc="{timings.connections_opened} connections opened"',
+        f"mapper;dur={timings.mapper_seconds * 1000:.2f}",
+        f"render;dur={timings.render_seconds * 1000:.2f}",
+        f"compress;dur={timings.compression_seconds * 1000:.2f}",
+    ])
+
+def init_app(app) -> None:
+    """Registers the request hooks. Must be called before any other after_request hook is registered,
+    so that its own after_request hook runs last and sees the final response."""
+    if not METRICS_ENABLED:
+        return
+
+    from flask import before_render_template, request, template_rendered
+
+    @app.before_request
+    def start_request_timings():
+        local.timings = RequestTimings()
+        local.start = time.perf_counter()
+        local.render_starts = []
+        if PROFILE_SLOW_REQUEST_MS > 0:
+            profiler.start(threading.get_ident())
+
+    @app.after_request
+    def finish_request_timings(response):
+        timings = current()
+        if timings is None:
+            return response
+
+        duration = time.perf_counter() - local.start
+        endpoint = request.endpoint or "none"
+        response.headers["Server-Timing"] = server_timing(timings, duration)
+
+        inc("diddle_http_requests_total", endpoint=endpoint, method=request.method, status=str(response.status_code))
+        observe("diddle_http_request_duration_seconds", duration, endpoint=endpoint)
+        inc("diddle_sql_statements_total", timings.sql_statements, endpoint=endpoint)
+        inc("diddle_db_connections_opened_total", timings.connections_opened, endpoint=endpoint)
+        inc("diddle_mapper_seconds_total", timings.mapper_seconds, endpoint=endpoint)
+        inc("diddle_template_render_seconds_total", timings.render_seconds, endpoint=endpoint)
+        inc("diddle_compression_seconds_total", timings.compression_seconds, endpoint=endpoint)
+
+        if PROFILE_SLOW_REQUEST_MS > 0:
+            stacks = profiler.stop(threading.get_ident())
+            if duration * 1000 >= PROFILE_SLOW_REQUEST_MS and len(stacks) > 0:
+                write_profile(endpoint, duration, stacks)
+
+        flush()
+        return response
+
+    @app.teardown_request
+    def clear_request_timings(e):
+        local.timings = None
+        if PROFILE_SLOW_REQUEST_MS > 0:
+            profiler.stop(threading.get_ident())
+
+    def render_started(sender, template, context, **extra):
+        if current() is not None:
+            local.render_starts.append(time.perf_counter())
+
+    def render_finished(sender, template, context, **extra):
+        if current() is not None and len(local.render_starts) > 0:
+            start = local.render_starts.pop()
+            # Only count the outermost template of nested renders
+            if len(local.render_starts) == 0:
+                add_time("render_seconds", time.perf_counter() - start)
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
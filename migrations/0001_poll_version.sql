@@ -0,0 +1,3 @@
+-- Bumped by every mutation of a poll, its choices or its votes. Lets readers
+-- in any worker process cheaply check whether a cached poll is still current.
+ALTER TABLE polls ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,15 @@
+-- Durable background jobs, see jobs.py. Finished jobs are deleted, failed jobs
+-- are kept with their last error for inspection.
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', -- pending, running or failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_until TEXT,
+    last_error TEXT,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+) STRICT;
+
+CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs (status, run_after);
@@ -0,0 +1,5 @@
+-- Pending jobs with the same coalesce_key are merged into one, e.g. a digest
+-- of participation emails for a poll.
+ALTER TABLE jobs ADD COLUMN coalesce_key TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_jobs_coalesce_key_status ON jobs (coalesce_key, status);
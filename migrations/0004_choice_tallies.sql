@@ -0,0 +1,5 @@
+-- Number of votes with value 1 per choice, maintained by db.py in the same
+-- transaction as the votes themselves.
+ALTER TABLE choices ADD COLUMN yes_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE choices SET yes_count = (SELECT count(*) FROM votes WHERE votes.choice_id = choices.id AND votes.value = 1);
@@ -0,0 +1,5 @@
+-- Time of the last mutation of a poll, its choices or its votes. Served as
+-- Last-Modified and updated together with polls.version.
+ALTER TABLE polls ADD COLUMN updated_at TEXT;
+
+UPDATE polls SET updated_at = pub_date;
@@ -0,0 +1,90 @@
+-- Integer primary keys instead of TEXT UUIDs. The UUIDs of polls and choices
+-- are kept as public lookup columns, generated by db.py. Voters are stored
+-- once in their own table and votes only reference a voter and a choice.
+--
+-- Tables are rebuilt as described in https://www.sqlite.org/lang_altertable.html,
+-- with foreign keys off and in a single transaction.
+PRAGMA foreign_keys = off;
+
+BEGIN;
+
+CREATE TABLE polls_new (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    description TEXT,
+    pub_date TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    author_name TEXT NOT NULL,
+    author_email TEXT,
+    manage_code TEXT NOT NULL UNIQUE,
+    whole_day INTEGER NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT
+) STRICT;
+
+CREATE TABLE choices_new (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT NOT NULL UNIQUE,
+    poll_id INTEGER NOT NULL,
+    start_datetime TEXT NOT NULL,
+    end_datetime TEXT NOT NULL,
+    yes_count INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (poll_id) REFERENCES polls_new (id) ON DELETE CASCADE
+) STRICT;
+
+CREATE TABLE voters (
+    id INTEGER PRIMARY KEY,
+    poll_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    manage_code TEXT NOT NULL UNIQUE,
+    UNIQUE (poll_id, name),
+    FOREIGN KEY (poll_id) REFERENCES polls_new (id) ON DELETE CASCADE
+) STRICT;
+
+CREATE TABLE votes_new (
+    voter_id INTEGER NOT NULL,
+    choice_id INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (voter_id, choice_id),
+    FOREIGN KEY (voter_id) REFERENCES voters (id) ON DELETE CASCADE,
+    FOREIGN KEY (choice_id) REFERENCES choices_new (id) ON DELETE CASCADE
+) STRICT, WITHOUT ROWID;
+
+INSERT INTO polls_new (uuid, title, description, pub_date, author_name, author_email, manage_code, whole_day, version, updated_at)
+SELECT id, title, description, pub_date, author_name, author_email, manage_code, whole_day, version, updated_at
+FROM polls;
+
+INSERT INTO choices_new (uuid, poll_id, start_datetime, end_datetime, yes_count)
+SELECT choices.id, polls_new.id, choices.start_datetime, choices.end_datetime, choices.yes_count
+FROM choices JOIN polls_new ON polls_new.uuid = choices.poll_id;
+
+-- All vote rows of a voter share the manage code
+INSERT INTO voters (poll_id, name, manage_code)
+SELECT polls_new.id, votes.voter_name, min(votes.manage_code)
+FROM votes JOIN polls_new ON polls_new.uuid = votes.poll_id
+GROUP BY polls_new.id, votes.voter_name;
+
+INSERT INTO votes_new (voter_id, choice_id, value)
+SELECT voters.id, choices_new.id, votes.value
+FROM votes
+JOIN polls_new ON polls_new.uuid = votes.poll_id
+JOIN voters ON voters.poll_id = polls_new.id AND voters.name = votes.voter_name
+JOIN choices_new ON choices_new.uuid = votes.choice_id;
+
+DROP TABLE votes;
+DROP TABLE choices;
+DROP TABLE polls;
+
+-- Renaming also updates the foreign keys that reference the renamed tables
+ALTER TABLE polls_new RENAME TO polls;
+ALTER TABLE choices_new RENAME TO choices;
+ALTER TABLE votes_new RENAME TO votes;
+
+CREATE INDEX idx_choices_poll_id_start_datetime ON choices (poll_id, start_datetime);
+CREATE INDEX idx_votes_choice_id ON votes (choice_id);
+
+COMMIT;
+
+PRAGMA foreign_keys = on;
+
+VACUUM;
@@ -0,0 +1,36 @@
+# Stores the votes of each voter as one bitmap on the voters row instead of a
+# votes row per choice, see the comment on blob_to_bitmap in db.py. Per-choice
+# tallies are counted from the bitmaps, so choices.yes_count is dropped.
+#
+# Building blobs needs Python: SQLite before 3.41 has no unhex().
+import sqlite3
+
+import db
+
+def migrate(cur: sqlite3.Cursor) -> None:
+    cur.execute("ALTER TABLE polls ADD COLUMN next_slot INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE choices ADD COLUMN slot INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE voters ADD COLUMN votes BLOB NOT NULL DEFAULT x''")
+    cur.execute("ALTER TABLE voters ADD COLUMN slot_count INTEGER NOT NULL DEFAULT 0")
+
+    # Slots in the order the choices were added
+    cur.execute("UPDATE choices SET slot = numbered.slot "
+                "FROM (SELECT id, row_number() OVER (PARTITION BY poll_id ORDER BY id) - 1 AS slot FROM choices) AS numbered "
+                "WHERE numbered.id = choices.id")
+    cur.execute("UPDATE polls SET next_slot = (SELECT count(*) FROM choices WHERE poll_id = polls.id)")
+
+    # A voter has votes on the choices that existed when they voted, which
+    # are the ones below the highest slot they have a vote for
+    bitmaps: dict[int, int] = {}
+    slot_counts: dict[int, int] = {}
+    cur.execute("SELECT votes.voter_id, choices.slot, votes.value FROM votes JOIN choices ON choices.id = votes.choice_id")
+    for voter_id, slot, value in cur.fetchall():
+        bitmaps[voter_id] = bitmaps.get(voter_id, 0) | (value << slot)
+        slot_counts[voter_id] = max(slot_counts.get(voter_id, 0), slot + 1)
+
+    cur.executemany("UPDATE voters SET votes = ?, slot_count = ? WHERE id = ?",
+                    [(db.bitmap_to_blob(bitmap, slot_counts[voter_id]), slot_counts[voter_id], voter_id)
+                     for voter_id, bitmap in bitmaps.items()])
+
+    cur.execute("DROP TABLE votes")
+    cur.execute("ALTER TABLE choices DROP COLUMN yes_count")
@@ -0,0 +1,6 @@
+-- Lets purge_expired_polls.py return the pages of deleted polls to the file
+-- system with incremental_vacuum. A new auto_vacuum mode only takes effect on
+-- an existing database after a VACUUM.
+PRAGMA auto_vacuum = INCREMENTAL;
+
+VACUUM;
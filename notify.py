@@ -0,0 +1,131 @@
+"""Fans poll changes out to the open event streams of every worker process.
+
+Each worker process with open streams binds a Unix datagram socket named
+after its pid in NOTIFY_DIR. publish, registered as a db poll change
+listener, sends every committed change to all sockets in there, so streams
+learn about changes made in any worker without polling the database.
+Sockets of processes that are gone are removed by the next publish.
+"""
+import json
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict
+from typing import Optional
+
+import db
+
+NOTIFY_DIR = os.environ.get("NOTIFY_DIR", os.path.join(tempfile.gettempdir(), "diddle_notify"))
+SSE_MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", "8"))
+SSE_KEEPALIVE_INTERVAL = float(os.environ.get("SSE_KEEPALIVE_INTERVAL", "15"))
+# How long browsers wait before reconnecting an interrupted stream
+SSE_RETRY_MS = 5000
+
+# Limits the threads of a worker process held by streams
+streams = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+lock = threading.Lock()
+# Queues of the streams of this process by poll id, a None ends the stream
+subscribers: dict[str, set[queue.SimpleQueue]] = {}
+listener_pid: Optional[int] = None
+listener_socket: Optional[socket.socket] = None
+
+def socket_path(pid: int) -> str:
+    return os.path.join(NOTIFY_DIR, f"{pid}.sock")
+
+def publish(change: db.PollChange) -> None:
+    if not os.path.isdir(NOTIFY_DIR):
+        return
+
+    message = json.dumps(asdict(change)).encode()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        # Never hold up the request that made the change
+        sock.setblocking(False)
+        for name in os.listdir(NOTIFY_DIR):
+            if not name.endswith(".sock"):
+                continue
+            path = os.path.join(NOTIFY_DIR, name)
+            try:
+                sock.sendto(message, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Nobody is bound to it any more
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                # The receiving process is too far behind, drop the change rather than wait
+                pass
+
+def start_listener() -> None:
+    """Binds the socket of this process and starts receiving changes unless that is done already."""
+    global listener_pid, listener_socket
+    with lock:
+        if listener_pid == os.getpid():
+            return
+
+        os.makedirs(NOTIFY_DIR, exist_ok=True)
+        path = socket_path(os.getpid())
+        if os.path.exists(path):
+            # Left behind by an earlier process with the same pid
+            os.remove(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        listener_pid = os.getpid()
+        listener_socket = sock
+    threading.Thread(target=listen, args=(sock,), daemon=True).start()
+
+def stop_listener() -> None:
+    """Removes the socket of this process, called when a gunicorn worker exits."""
+    with lock:
+        if listener_pid != os.getpid() or listener_socket is None:
+            return
+        listener_socket.close()
+        try:
+            os.remove(socket_path(os.getpid()))
+        except FileNotFoundError:
+            pass
+
+def listen(sock: socket.socket) -> None:
+    while True:
+        try:
+            message = sock.recv(65536)
+        except OSError:
+            # Closed by stop_listener
+            return
+        try:
+            change = db.PollChange(**json.loads(message))
+        except (ValueError, TypeError):
+            # Not sent by publish, e.g. truncated, keep listening
+            print(f"Ignoring invalid poll change message: {message[:200]!r}", file=sys.stderr)
+            continue
+        with lock:
+            queues = list(subscribers.get(change.poll_id, ()))
+        for changes in queues:
+            changes.put(change)
+
+@contextmanager
+def subscribe(poll_id: str):
+    """Yields a queue receiving the changes of the poll until the block exits."""
+    start_listener()
+    changes: queue.SimpleQueue[Optional[db.PollChange]] = queue.SimpleQueue()
+    with lock:
+        subscribers.setdefault(poll_id, set()).add(changes)
+    try:
+        yield changes
+    finally:
+        with lock:
+            subscribers[poll_id].discard(changes)
+            if len(subscribers[poll_id]) == 0:
+                del subscribers[poll_id]
+
+def close_streams() -> None:
+    """Ends every stream of this process, so that a stopping worker does not wait for them."""
+    with lock:
+        for queues in subscribers.values():
+            for changes in queues:
+                changes.put(None)
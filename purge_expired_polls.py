@@ -0,0 +1,58 @@
+"""Deletes polls that expired more than RETENTION_DAYS days ago and reclaims their space.
+
+Run it periodically, e.g. daily from cron. Polls are deleted in batches of
+RETENTION_BATCH_SIZE per transaction, so the app stays writable meanwhile.
+If RETENTION_ARCHIVE_PATH is set, every poll is appended to that file as a
+line of JSON before it is deleted. Failed background jobs created more than
+RETENTION_DAYS days ago are deleted as well.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import dataclasses
+import datetime
+import json
+import os
+import sys
+
+import db
+import notify
+
+# Lets the live updates of open poll pages know about deleted polls
+db.poll_change_listeners.append(notify.publish)
+
+RETENTION_DAYS = os.environ.get("RETENTION_DAYS")
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", "100"))
+RETENTION_ARCHIVE_PATH = os.environ.get("RETENTION_ARCHIVE_PATH")
+
+if RETENTION_DAYS is None:
+  print("RETENTION_DAYS is not set, not deleting any polls.")
+  sys.exit(0)
+
+cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=int(RETENTION_DAYS))
+print(f"* Deleting polls that expired before {cutoff.strftime(db.DB_DATE_FORMAT)}")
+
+size_before = db.database_size()
+
+if RETENTION_ARCHIVE_PATH is not None:
+  with open(RETENTION_ARCHIVE_PATH, "a") as archive_file:
+    def archive_value(value):
+      # Datetimes and the choice id sets of voters
+      return sorted(value) if isinstance(value, frozenset) else str(value)
+
+    def archive(poll: db.Poll):
+      archive_file.write(json.dumps(dataclasses.asdict(poll), default=archive_value) + "\n")
+
+    report = db.purge_expired_polls(cutoff, RETENTION_BATCH_SIZE, archive=archive)
+  print(f"* Archived {report.polls} polls to {RETENTION_ARCHIVE_PATH}")
+else:
+  report = db.purge_expired_polls(cutoff, RETENTION_BATCH_SIZE)
+
+print(f"* Deleted {report.polls} polls, {report.choices} choices and {report.voters} voters in {report.batches} batches")
+
+failed_jobs = db.purge_failed_jobs(cutoff)
+print(f"* Deleted {failed_jobs} failed jobs")
+
+db.reclaim_space()
+size_after = db.database_size()
+print(f"* Database size {size_before} -> {size_after} bytes, {size_before - size_after} bytes reclaimed")
@@ -2,4 +2,5 @@
 set -euxo pipefail
 
 python apply_migrations.py
-gunicorn --bind "0.0.0.0:8000" -w 4 app:app
+python purge_expired_polls.py
+gunicorn -c gunicorn.conf.py app:app